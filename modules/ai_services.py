@@ -4,142 +4,278 @@
 
 import os
 import asyncio
-import tempfile
-import base64
-from typing import Optional, List, Dict, Any
-import requests
-import fal_client
+import json
+from contextlib import asynccontextmanager
+from typing import Optional, List, Any, Union, Tuple, Callable, Awaitable
 from google import genai
 from google.genai import types
 
 from modules.config import (
     GEMINI_API_KEY, SYSTEM_PROMPT,
     IMAGE_ANALYSIS_PROMPT, DEFAULT_GEMINI_MODEL, MAX_TOKENS,
-    TIMEOUT, MAX_RETRIES, logger, FAL_MODEL_ID, FAL_LORA_URL,
-    FAL_LORA_SCALE, TRIGGER_WORD
+    MAX_RETRIES, logger, FAL_LORA_URL,
+    FAL_LORA_SCALE, TRIGGER_WORD, GEMINI_TIMEOUT, GEMINI_MAX_CONCURRENCY
 )
 from modules.settings import get_user_settings
+from modules.fal_dispatcher import run_fal, PRIORITY_INTERACTIVE, PRIORITY_BENCHMARK
+from modules.prompt_cache import prompt_cache, image_analysis_cache, make_cache_key
+from modules.http_client import fetch_to_file
 
 # Инициализация клиента Gemini
 gemini_client = genai.Client(api_key=GEMINI_API_KEY)
 
+# Ограничение одновременных запросов к Gemini со всего бота
+_gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
 
-async def generate_prompt(text: str, user_id: int = None) -> Optional[str]:
+
+async def gemini_generate_content(**kwargs) -> types.GenerateContentResponse:
+    """
+    Выполняет запрос к Gemini через асинхронный клиент, не блокируя event loop.
+
+    Число одновременных запросов ограничено GEMINI_MAX_CONCURRENCY, а каждый
+    запрос прерывается по GEMINI_TIMEOUT. Отмена вызывающей задачи
+    (например, при /cancel) отменяет и сам HTTP-запрос.
+
+    Args:
+        **kwargs: Аргументы для client.aio.models.generate_content
+
+    Returns:
+        Ответ Gemini
+
+    Raises:
+        asyncio.TimeoutError: Если ответ не получен за GEMINI_TIMEOUT секунд
+    """
+    async with _gemini_semaphore:
+        return await asyncio.wait_for(
+            gemini_client.aio.models.generate_content(**kwargs),
+            timeout=GEMINI_TIMEOUT,
+        )
+
+
+async def gemini_stream_text(
+    on_partial: Callable[[str], Awaitable[None]],
+    **kwargs,
+) -> str:
+    """
+    Выполняет потоковый запрос к Gemini и возвращает полный текст ответа.
+
+    По мере поступления частей ответа вызывает on_partial с уже полученным
+    текстом. Ограничения те же, что у gemini_generate_content: общий семафор
+    и GEMINI_TIMEOUT на весь поток. Отмена задачи прерывает поток, и Gemini
+    перестаёт генерировать (и тарифицировать) оставшиеся токены.
+
+    Args:
+        on_partial: Callback с накопленным текстом
+        **kwargs: Аргументы для client.aio.models.generate_content_stream
+
+    Returns:
+        Полный текст ответа
+    """
+    async def collect() -> str:
+        text = ""
+        stream = await gemini_client.aio.models.generate_content_stream(**kwargs)
+        async for chunk in stream:
+            if chunk.text:
+                text += chunk.text
+                try:
+                    await on_partial(text)
+                except Exception as e:
+                    logger.warning(f"Ошибка обновления предпросмотра: {e}")
+        return text
+
+    async with _gemini_semaphore:
+        return await asyncio.wait_for(collect(), timeout=GEMINI_TIMEOUT)
+
+
+# Температура генерации промптов (входит в ключ кэша промптов)
+PROMPT_TEMPERATURE = 0.7
+
+# Модель и инструкция для описания изображений (входят в ключ кэша описаний)
+IMAGE_DESCRIPTION_MODEL = "gemini-2.5-flash"
+IMAGE_DESCRIPTION_INSTRUCTION = "Ты - эксперт по детальному анализу изображений. Опиши изображение максимально подробно, включая объекты, людей, цвета, композицию, освещение, эмоции и атмосферу. Сосредоточься на визуальных аспектах и деталях, которые можно использовать для генерации похожего изображения."
+
+
+def _get_gemini_model(user_id: Optional[int]) -> str:
+    """Возвращает модель Gemini из настроек пользователя."""
+    if user_id:
+        settings = get_user_settings(user_id)
+        return settings.get("gemini_model", DEFAULT_GEMINI_MODEL)
+    return DEFAULT_GEMINI_MODEL
+
+
+async def _generate_cached_prompt(
+    model: str,
+    system_prompt: str,
+    text: str,
+    use_cache: bool,
+    on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> str:
+    """
+    Генерирует промпт с триггер-словом, используя кэш промптов.
+
+    Args:
+        model: Модель Gemini
+        system_prompt: Системная инструкция
+        text: Входной текст
+        use_cache: Брать ли промпт из кэша. При False запрос всегда идёт
+            в Gemini (для разнообразия при повторах), а результат
+            заменяет запись в кэше
+        on_partial: Если указан, ответ запрашивается потоком, и callback
+            получает промпт по мере генерации
+
+    Returns:
+        Промпт на английском языке с префиксом TRIGGER_WORD
+    """
+    key = make_cache_key(model, system_prompt, PROMPT_TEMPERATURE, text)
+    if use_cache:
+        cached = await prompt_cache.get(key)
+        if cached:
+            logger.info("Промпт взят из кэша")
+            return cached
+
+    request = dict(
+        model=model,
+        config=types.GenerateContentConfig(
+            system_instruction=system_prompt,
+            temperature=PROMPT_TEMPERATURE,
+            max_output_tokens=MAX_TOKENS,
+        ),
+        contents=text,
+    )
+    if on_partial:
+        prompt = (await gemini_stream_text(on_partial, **request)).strip()
+    else:
+        prompt = (await gemini_generate_content(**request)).text.strip()
+
+    tw = TRIGGER_WORD.lower()
+    if not prompt.lower().startswith(tw):
+        prompt = f"{TRIGGER_WORD} {prompt}"
+
+    await prompt_cache.set(key, prompt)
+    return prompt
+
+
+async def generate_prompt(
+    text: str,
+    user_id: int = None,
+    use_cache: bool = True,
+    on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> Optional[str]:
     """
     Генерирует промпт для создания изображения с помощью Gemini.
 
     Args:
         text: Запрос пользователя на русском языке
         user_id: ID пользователя для получения настроек
+        use_cache: Использовать кэш промптов (False — для повторной генерации)
+        on_partial: Callback для потокового предпросмотра промпта
 
     Returns:
         Промпт на английском языке с префиксом MLVNK или None в случае ошибки
     """
     try:
-        model = DEFAULT_GEMINI_MODEL
-        if user_id:
-            settings = get_user_settings(user_id)
-            model = settings.get("gemini_model", DEFAULT_GEMINI_MODEL)
-
+        model = _get_gemini_model(user_id)
         logger.info(f"Генерация промпта с использованием модели {model}")
-
-        response = gemini_client.models.generate_content(
-            model=model,
-            config=types.GenerateContentConfig(
-                system_instruction=SYSTEM_PROMPT,
-                temperature=0.7,
-                max_output_tokens=MAX_TOKENS,
-            ),
-            contents=text,
-        )
-
-        prompt = response.text.strip()
-
-        tw = TRIGGER_WORD.lower()
-        if not prompt.lower().startswith(tw):
-            prompt = f"{TRIGGER_WORD} {prompt}"
-
-        return prompt
+        return await _generate_cached_prompt(model, SYSTEM_PROMPT, text, use_cache, on_partial)
     except Exception as e:
         logger.error(f"Ошибка при генерации промпта: {e}")
         return None
 
 
-async def analyze_image(image_description: str, user_id: int = None) -> Optional[str]:
+async def analyze_image(
+    image_description: str,
+    user_id: int = None,
+    use_cache: bool = True,
+    on_partial: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> Optional[str]:
     """
     Генерирует промпт на основе описания изображения.
 
     Args:
         image_description: Описание изображения
         user_id: ID пользователя для получения настроек
+        use_cache: Использовать кэш промптов (False — для повторной генерации)
+        on_partial: Callback для потокового предпросмотра промпта
 
     Returns:
         Промпт для создания похожего изображения или None
     """
     try:
-        model = DEFAULT_GEMINI_MODEL
-        if user_id:
-            settings = get_user_settings(user_id)
-            model = settings.get("gemini_model", DEFAULT_GEMINI_MODEL)
-
+        model = _get_gemini_model(user_id)
         logger.info(f"Анализ изображения с использованием модели {model}")
-
-        response = gemini_client.models.generate_content(
-            model=model,
-            config=types.GenerateContentConfig(
-                system_instruction=IMAGE_ANALYSIS_PROMPT,
-                temperature=0.7,
-                max_output_tokens=MAX_TOKENS,
-            ),
-            contents=image_description,
+        return await _generate_cached_prompt(
+            model, IMAGE_ANALYSIS_PROMPT, image_description, use_cache, on_partial
         )
-
-        prompt = response.text.strip()
-
-        tw = TRIGGER_WORD.lower()
-        if not prompt.lower().startswith(tw):
-            prompt = f"{TRIGGER_WORD} {prompt}"
-
-        return prompt
     except Exception as e:
         logger.error(f"Ошибка при анализе изображения: {e}")
         return None
 
 
-async def transcribe_audio(audio_file_path: str) -> Optional[str]:
+@asynccontextmanager
+async def _media_part(media: Union[bytes, str], mime_type: str):
+    """
+    Готовит медиа для запроса к Gemini (асинхронный контекстный менеджер).
+
+    Байты передаются прямо в запросе. Путь к файлу — запасной вариант для
+    файлов больше MEDIA_INLINE_LIMIT: такой файл загружается через Files API,
+    так как размер встроенных данных в запросе ограничен, и удаляется оттуда
+    при выходе из контекста, после запроса, который его использует.
     """
-    Транскрибирует аудиофайл с помощью Gemini.
+    if isinstance(media, (bytes, bytearray)):
+        yield types.Part.from_bytes(data=bytes(media), mime_type=mime_type)
+        return
+
+    uploaded = await gemini_client.aio.files.upload(file=media, config={"mime_type": mime_type})
+    logger.info(f"Файл {media} загружен в Gemini Files API: {uploaded.name}")
+    try:
+        yield types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type or mime_type)
+    finally:
+        try:
+            await gemini_client.aio.files.delete(name=uploaded.name)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить файл {uploaded.name} из Gemini Files API: {e}")
+
+
+def _media_size(media: Union[bytes, str]) -> int:
+    if isinstance(media, (bytes, bytearray)):
+        return len(media)
+    return os.path.getsize(media) if os.path.exists(media) else 0
+
+
+def _image_mime_type(image: Union[bytes, str]) -> str:
+    if isinstance(image, (bytes, bytearray)):
+        return "image/png" if image[:8] == b"\x89PNG\r\n\x1a\n" else "image/jpeg"
+    return "image/png" if image.lower().endswith(".png") else "image/jpeg"
+
+
+async def transcribe_audio(audio: Union[bytes, str]) -> Optional[str]:
+    """
+    Транскрибирует аудио с помощью Gemini.
 
     Args:
-        audio_file_path: Путь к аудиофайлу
+        audio: Содержимое аудио (OGG) или путь к файлу для больших сообщений
 
     Returns:
         Транскрибированный текст или None в случае ошибки
     """
     try:
-        if not os.path.exists(audio_file_path):
-            logger.error(f"Файл аудио не найден: {audio_file_path}")
-            return None
-
-        file_size = os.path.getsize(audio_file_path)
-        if file_size == 0:
-            logger.error(f"Файл аудио пустой: {audio_file_path}")
+        size = _media_size(audio)
+        if size == 0:
+            logger.error("Аудио пустое или файл не найден")
             return None
 
-        logger.info(f"Отправка аудиофайла размером {file_size} байт на транскрибацию")
-
-        with open(audio_file_path, "rb") as f:
-            audio_data = f.read()
-
-        response = gemini_client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                types.Content(parts=[
-                    types.Part.from_bytes(data=audio_data, mime_type="audio/ogg"),
-                    types.Part.from_text("Транскрибируй это аудио на русском языке. Выведи только текст, без комментариев."),
-                ])
-            ],
-        )
+        logger.info(f"Отправка аудио размером {size} байт на транскрибацию")
+
+        async with _media_part(audio, "audio/ogg") as media_part:
+            response = await gemini_generate_content(
+                model="gemini-2.5-flash",
+                contents=[
+                    types.Content(parts=[
+                        media_part,
+                        types.Part.from_text(text="Транскрибируй это аудио на русском языке. Выведи только текст, без комментариев."),
+                    ])
+                ],
+            )
 
         transcribed_text = response.text.strip()
         logger.info(f"Транскрибация успешна, получен текст длиной {len(transcribed_text)} символов")
@@ -149,63 +285,181 @@ async def transcribe_audio(audio_file_path: str) -> Optional[str]:
         return None
 
 
-async def analyze_image_content(image_path: str, user_id: int = None) -> Optional[str]:
+def _image_description_key(file_unique_id: str, model: str = IMAGE_DESCRIPTION_MODEL,
+                           instruction: str = IMAGE_DESCRIPTION_INSTRUCTION) -> str:
+    """Ключ описания изображения: модель и инструкция, которыми оно получено, и file_unique_id."""
+    return make_cache_key(model, instruction, None, file_unique_id)
+
+
+async def get_cached_image_description(file_unique_id: str, user_id: int = None) -> Optional[str]:
+    """
+    Возвращает сохранённое описание изображения по file_unique_id фото Telegram.
+
+    file_unique_id одинаков для одного и того же файла у всех пользователей и
+    при пересылке, поэтому повторно отправленное фото не нужно ни скачивать,
+    ни заново анализировать. Сначала ищется описание, полученное
+    analyze_photo моделью пользователя, затем — analyze_image_content.
+    """
+    keys = (
+        _image_description_key(file_unique_id, _get_gemini_model(user_id), IMAGE_ANALYSIS_PROMPT),
+        _image_description_key(file_unique_id),
+    )
+    for key in keys:
+        description = await image_analysis_cache.get(key)
+        if description:
+            logger.info(f"Описание изображения {file_unique_id} взято из кэша")
+            return description
+    return None
+
+
+async def analyze_image_content(image: Union[bytes, str], user_id: int = None,
+                                file_unique_id: Optional[str] = None) -> Optional[str]:
     """
     Анализирует содержимое изображения с помощью Gemini.
 
     Args:
-        image_path: Путь к файлу изображения
+        image: Содержимое изображения или путь к файлу для больших изображений
         user_id: ID пользователя для получения настроек
+        file_unique_id: file_unique_id фото в Telegram; если указан,
+            описание сохраняется в кэш (см. get_cached_image_description)
 
     Returns:
         Описание изображения или None в случае ошибки
     """
     try:
-        if not os.path.exists(image_path):
-            logger.error(f"Файл изображения не найден: {image_path}")
+        size = _media_size(image)
+        if size == 0:
+            logger.error("Изображение пустое или файл не найден")
             return None
 
-        file_size = os.path.getsize(image_path)
-        if file_size == 0:
-            logger.error(f"Файл изображения пустой: {image_path}")
-            return None
+        logger.info(f"Обработка изображения размером {size} байт")
 
-        logger.info(f"Обработка изображения размером {file_size} байт")
-
-        with open(image_path, "rb") as f:
-            image_data = f.read()
-
-        mime_type = "image/jpeg"
-        if image_path.lower().endswith(".png"):
-            mime_type = "image/png"
-
-        response = gemini_client.models.generate_content(
-            model="gemini-2.5-flash",
-            config=types.GenerateContentConfig(
-                system_instruction="Ты - эксперт по детальному анализу изображений. Опиши изображение максимально подробно, включая объекты, людей, цвета, композицию, освещение, эмоции и атмосферу. Сосредоточься на визуальных аспектах и деталях, которые можно использовать для генерации похожего изображения.",
-                max_output_tokens=MAX_TOKENS,
-            ),
-            contents=[
-                types.Content(parts=[
-                    types.Part.from_bytes(data=image_data, mime_type=mime_type),
-                    types.Part.from_text("Опиши это изображение максимально подробно:"),
-                ])
-            ],
-        )
+        async with _media_part(image, _image_mime_type(image)) as media_part:
+            response = await gemini_generate_content(
+                model=IMAGE_DESCRIPTION_MODEL,
+                config=types.GenerateContentConfig(
+                    system_instruction=IMAGE_DESCRIPTION_INSTRUCTION,
+                    max_output_tokens=MAX_TOKENS,
+                ),
+                contents=[
+                    types.Content(parts=[
+                        media_part,
+                        types.Part.from_text(text="Опиши это изображение максимально подробно:"),
+                    ])
+                ],
+            )
 
-        return response.text
+        description = response.text
+        if file_unique_id and description:
+            await image_analysis_cache.set(_image_description_key(file_unique_id), description)
+        return description
     except Exception as e:
         logger.error(f"Ошибка при анализе содержимого изображения: {e}")
         return None
 
 
-async def generate_image(prompt: str, user_id: int) -> Optional[List[str]]:
+# Дополнение системной инструкции для получения описания и промпта одним запросом
+PHOTO_PROMPT_JSON_INSTRUCTION = """
+
+## Формат ответа
+Верни JSON-объект с двумя полями:
+- "description": подробное описание исходного изображения на русском языке (объекты, люди, цвета, композиция, освещение, атмосфера);
+- "prompt": итоговый промпт на английском языке для генерации изображения по правилам выше.
+"""
+
+PHOTO_PROMPT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "description": {"type": "STRING"},
+        "prompt": {"type": "STRING"},
+    },
+    "required": ["description", "prompt"],
+}
+
+
+async def analyze_photo(image: Union[bytes, str], user_id: int = None,
+                        file_unique_id: Optional[str] = None) -> Optional[Tuple[str, str]]:
+    """
+    Получает описание изображения и промпт по нему одним мультимодальным запросом.
+
+    Заменяет последовательные analyze_image_content и analyze_image: изображение
+    отправляется сразу с IMAGE_ANALYSIS_PROMPT, а ответ приходит в JSON.
+    Описание сохраняется в кэш описаний (по модели, IMAGE_ANALYSIS_PROMPT и
+    file_unique_id), а промпт — в кэш промптов под тем же ключом, что дал бы
+    analyze_image(description), поэтому повтор и циклы работают с описанием
+    так же, как в двухшаговом режиме.
+
+    Args:
+        image: Содержимое изображения или путь к файлу для больших изображений
+        user_id: ID пользователя для получения настроек
+        file_unique_id: file_unique_id фото в Telegram
+
+    Returns:
+        Кортеж (описание, промпт) или None в случае ошибки
+    """
+    try:
+        size = _media_size(image)
+        if size == 0:
+            logger.error("Изображение пустое или файл не найден")
+            return None
+
+        model = _get_gemini_model(user_id)
+        logger.info(f"Анализ изображения размером {size} байт одним запросом к модели {model}")
+
+        async with _media_part(image, _image_mime_type(image)) as media_part:
+            response = await gemini_generate_content(
+                model=model,
+                config=types.GenerateContentConfig(
+                    system_instruction=IMAGE_ANALYSIS_PROMPT + PHOTO_PROMPT_JSON_INSTRUCTION,
+                    temperature=PROMPT_TEMPERATURE,
+                    max_output_tokens=MAX_TOKENS,
+                    response_mime_type="application/json",
+                    response_schema=PHOTO_PROMPT_SCHEMA,
+                ),
+                contents=[
+                    types.Content(parts=[
+                        media_part,
+                        types.Part.from_text(text="Проанализируй это изображение и создай промпт для генерации похожего."),
+                    ])
+                ],
+            )
+
+        data = json.loads(response.text)
+        description = data["description"].strip()
+        prompt = data["prompt"].strip()
+        if not description or not prompt:
+            raise ValueError("пустое описание или промпт в ответе")
+
+        tw = TRIGGER_WORD.lower()
+        if not prompt.lower().startswith(tw):
+            prompt = f"{TRIGGER_WORD} {prompt}"
+
+        if file_unique_id:
+            await image_analysis_cache.set(
+                _image_description_key(file_unique_id, model, IMAGE_ANALYSIS_PROMPT), description
+            )
+        await prompt_cache.set(make_cache_key(model, IMAGE_ANALYSIS_PROMPT, PROMPT_TEMPERATURE, description), prompt)
+        return description, prompt
+    except Exception as e:
+        logger.error(f"Ошибка при анализе изображения одним запросом: {e}")
+        return None
+
+
+async def generate_image(
+    prompt: str,
+    user_id: int,
+    on_status: Optional[Callable[[Any], Any]] = None,
+    on_submitted: Optional[Callable[[str], Any]] = None,
+) -> Optional[List[str]]:
     """
     Отправляет запрос на генерацию изображения через fal.ai API.
 
     Args:
         prompt: Промпт для генерации изображения
         user_id: ID пользователя Telegram
+        on_status: Callback статуса запроса (позиция в очереди, ход генерации), см. run_fal
+        on_submitted: Callback сохранения request_id (JobTracker.callback) — запрос
+            переживает перезапуск бота, см. generation_jobs
 
     Returns:
         Список URL сгенерированных изображений или None в случае ошибки
@@ -254,15 +508,13 @@ async def generate_image(prompt: str, user_id: int) -> Optional[List[str]]:
         try:
             logger.info(f"Отправка запроса на генерацию. image_size={image_size}, num_images={num_outputs}")
 
-            loop = asyncio.get_running_loop()
-            result = await loop.run_in_executor(
-                None,
-                lambda: fal_client.subscribe(
-                    FAL_MODEL_ID,
-                    arguments=arguments,
-                    with_logs=True,
-                    on_queue_update=lambda u: logger.info(f"fal.ai прогресс: {u}") if isinstance(u, fal_client.InProgress) else None,
-                ),
+            result = await run_fal(
+                arguments,
+                priority=PRIORITY_INTERACTIVE,
+                user_id=user_id,
+                on_queue_update=on_status,
+                on_submitted=on_submitted,
+                durable=on_submitted is not None,
             )
 
             images = result.get("images", [])
@@ -284,13 +536,22 @@ async def generate_image(prompt: str, user_id: int) -> Optional[List[str]]:
     return None
 
 
-async def generate_image_with_params(prompt: str, params: dict) -> Optional[List[str]]:
+async def generate_image_with_params(
+    prompt: str,
+    params: dict,
+    user_id: Optional[int] = None,
+    priority: int = PRIORITY_BENCHMARK,
+    metrics: Optional[dict] = None,
+) -> Optional[List[str]]:
     """
     Генерирует изображение с заданными параметрами через fal.ai API.
 
     Args:
         prompt: Текстовое описание для генерации
         params: Словарь с параметрами генерации
+        user_id: ID пользователя Telegram (для распределения слотов fal.ai)
+        priority: Приоритет запроса в диспетчере fal.ai
+        metrics: Словарь для отметок времени запроса (см. run_fal)
 
     Returns:
         Список URL-адресов сгенерированных изображений или None
@@ -314,18 +575,12 @@ async def generate_image_with_params(prompt: str, params: dict) -> Optional[List
         "enable_safety_checker": False,
         "loras": loras,
     }
+    if params.get("seed") is not None:
+        # Фиксированный seed позволяет сравнивать параметры на одном и том же шуме
+        arguments["seed"] = params["seed"]
 
     try:
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: fal_client.subscribe(
-                FAL_MODEL_ID,
-                arguments=arguments,
-                with_logs=True,
-                on_queue_update=lambda u: None,
-            ),
-        )
+        result = await run_fal(arguments, priority=priority, user_id=user_id, metrics=metrics)
 
         images = result.get("images", [])
         if not images:
@@ -343,7 +598,7 @@ async def generate_image_with_params(prompt: str, params: dict) -> Optional[List
 
 async def download_file(file_url: str, local_filename: Optional[str] = None) -> Optional[str]:
     """
-    Скачивает файл по URL.
+    Скачивает файл по URL через общий HTTP-клиент.
 
     Args:
         file_url: URL файла
@@ -352,20 +607,8 @@ async def download_file(file_url: str, local_filename: Optional[str] = None) ->
     Returns:
         Путь к скачанному файлу или None в случае ошибки
     """
-    if not local_filename:
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        local_filename = tmp.name
-        tmp.close()
-
     try:
-        with requests.get(file_url, stream=True, timeout=TIMEOUT) as r:
-            r.raise_for_status()
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        return local_filename
+        return await fetch_to_file(file_url, local_filename)
     except Exception as e:
         logger.error(f"Ошибка при скачивании файла: {e}")
-        if os.path.exists(local_filename):
-            os.remove(local_filename)
         return None
@@ -0,0 +1,954 @@
+"""
+Модуль прогона параметров генерации (benchmark).
+
+Комбинации параметров генерируются параллельно в пределах
+BENCHMARK_CONCURRENCY слотов fal.ai (с низким приоритетом в глобальном
+диспетчере), результаты отправляются альбомами по мере готовности,
+а статусное сообщение обновляется не чаще BENCHMARK_STATUS_INTERVAL.
+Прогон выполняется в фоновой задаче и останавливается командой /cancel.
+
+Каждый прогон сохраняется в SQLite как задание (промпт, комбинации,
+результаты выполненных комбинаций). После перезапуска бота незавершённые
+задания возобновляются, а уже выполненные комбинации пропускаются.
+
+Адаптивный поиск (AdaptiveSearch) вместо полного перебора выбирает
+конфигурации латинским гиперкубом, генерирует их на малом числе шагов
+и методом последовательного деления (successive halving) переводит на
+следующие шаги только лучшие по автоматической оценке резкости.
+
+Для каждой генерации собираются метрики (ожидание слота, очередь fal.ai,
+инференс, размер и время скачивания); по окончании прогона отправляется
+сводная таблица и CSV-отчёт.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import random
+import statistics
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageFilter, ImageStat
+
+from modules.config import (
+    BENCHMARK_SETTINGS, BENCHMARK_PROMPT_STRENGTHS, BENCHMARK_GUIDANCE_SCALES,
+    BENCHMARK_INFERENCE_STEPS, BENCHMARK_CONCURRENCY, BENCHMARK_STATUS_INTERVAL,
+    BENCHMARK_ADAPTIVE_INITIAL, BENCHMARK_ADAPTIVE_ETA, BENCHMARK_FLUSH_ATTEMPTS, logger
+)
+from modules.ai_services import generate_image_with_params
+from modules.delivery import send_album, send_text, rate_limiter, MEDIA_GROUP_LIMIT
+from modules.http_client import fetch_bytes
+from modules.storage import SQLiteDatabase
+
+# Активные прогоны: user_id -> задача
+active_sweeps: Dict[int, asyncio.Task] = {}
+
+
+def build_combinations() -> List[dict]:
+    """Возвращает все комбинации перебираемых параметров."""
+    combinations = []
+    for prompt_strength in BENCHMARK_PROMPT_STRENGTHS:
+        for guidance_scale in BENCHMARK_GUIDANCE_SCALES:
+            for inference_steps in BENCHMARK_INFERENCE_STEPS:
+                combinations.append({
+                    "prompt_strength": prompt_strength,
+                    "guidance_scale": guidance_scale,
+                    "num_inference_steps": inference_steps
+                })
+    return combinations
+
+
+def format_params(params: dict) -> str:
+    """Форматирует параметры комбинации для подписи."""
+    strength = f"• Сила промпта: {params['prompt_strength']}\n" if "prompt_strength" in params else ""
+    return (
+        f"{strength}"
+        f"• Guidance Scale: {params['guidance_scale']}\n"
+        f"• Шаги инференса: {params['num_inference_steps']}"
+    )
+
+
+# Параметры, которые адаптивный поиск перебирает. Сила промпта не входит:
+# текстовая генерация fal.ai её не принимает, и конфигурации, отличающиеся
+# только ею, давали бы одинаковые изображения при общем seed
+ADAPTIVE_PARAMS = ("guidance_scale",)
+
+
+def latin_hypercube(count: int, rng: random.Random = random) -> List[dict]:
+    """
+    Выбирает конфигурации адаптивного поиска латинским гиперкубом.
+
+    Диапазон каждого параметра из ADAPTIVE_PARAMS (от минимума до максимума
+    сетки прогона) делится на count равных слоёв, из каждого слоя берётся
+    одно случайное значение с шагом 0.05, а слои разных параметров
+    перемешиваются. Так даже небольшая выборка покрывает весь диапазон.
+    """
+    dimensions = {
+        "guidance_scale": BENCHMARK_GUIDANCE_SCALES,
+    }
+    columns = {}
+    for name, values in dimensions.items():
+        low, high = min(values), max(values)
+        column = [
+            round(round((low + (i + rng.random()) * (high - low) / count) / 0.05) * 0.05, 2)
+            for i in range(count)
+        ]
+        rng.shuffle(column)
+        columns[name] = column
+
+    return unique_configs([
+        {name: columns[name][i] for name in dimensions}
+        for i in range(count)
+    ])
+
+
+def unique_configs(configs: List[dict]) -> List[dict]:
+    """
+    Оставляет в конфигурациях только параметры, передаваемые в fal.ai
+    (ADAPTIVE_PARAMS), и убирает дубликаты, чтобы не платить за одинаковые генерации.
+    """
+    unique = []
+    for config in configs:
+        effective = {name: config[name] for name in ADAPTIVE_PARAMS}
+        if effective not in unique:
+            unique.append(effective)
+    return unique
+
+
+def rung_steps(initial: int = BENCHMARK_ADAPTIVE_INITIAL, eta: int = BENCHMARK_ADAPTIVE_ETA) -> List[int]:
+    """Возвращает число шагов инференса для каждого этапа адаптивного поиска."""
+    steps = sorted(BENCHMARK_INFERENCE_STEPS)
+    # Этапов столько, сколько раз initial можно разделить на eta, плюс первый
+    rungs, remaining = 1, initial
+    while remaining > 1:
+        remaining //= eta
+        rungs += 1
+    rungs = min(len(steps), rungs)
+    if rungs == 1:
+        return [steps[-1]]
+    return [steps[round(i * (len(steps) - 1) / (rungs - 1))] for i in range(rungs)]
+
+
+def image_quality_score(data: bytes) -> float:
+    """
+    Автоматическая оценка качества изображения по резкости.
+
+    Считается дисперсия лапласиана яркости: размытые изображения получают
+    низкую оценку. Остаточный шум (типичный для малого числа шагов) сам по
+    себе повышает дисперсию лапласиана, поэтому перед ним применяется
+    медианный фильтр 3×3: он подавляет попиксельный шум, сохраняя контуры,
+    и шумное изображение не получает завышенную оценку.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        gray = image.convert("L")
+        gray.thumbnail((512, 512))
+        gray = gray.filter(ImageFilter.MedianFilter(3))
+        laplacian = gray.filter(ImageFilter.Kernel(
+            (3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale=1, offset=128
+        ))
+        return ImageStat.Stat(laplacian).var[0]
+
+
+# ─────────────────────────────────────────────
+# Метрики и отчёт
+# ─────────────────────────────────────────────
+
+REPORT_FIELDS = [
+    "number", "rung", "prompt_strength", "guidance_scale", "num_inference_steps",
+    "success", "submitted_at", "dispatcher_wait_s", "fal_queue_s", "inference_s",
+    "total_s", "download_bytes", "download_s", "score",
+]
+
+
+def _elapsed(timings: dict, start: str, end: str) -> Optional[float]:
+    if start in timings and end in timings:
+        return round(timings[end] - timings[start], 3)
+    return None
+
+
+def combination_metrics(number: int, params: dict, timings: dict, success: bool,
+                        download_bytes: Optional[int] = None,
+                        download_s: Optional[float] = None, **extra) -> dict:
+    """
+    Собирает строку отчёта по одной генерации.
+
+    Args:
+        number: Номер комбинации
+        params: Параметры генерации
+        timings: Отметки времени, заполненные run_fal
+        success: Получено ли изображение
+        download_bytes: Размер скачанного изображения
+        download_s: Время скачивания
+        extra: Дополнительные поля (rung, score)
+    """
+    submitted = timings.get("submitted_at")
+    record = {
+        "number": number,
+        "prompt_strength": params.get("prompt_strength"),
+        "guidance_scale": params.get("guidance_scale"),
+        "num_inference_steps": params.get("num_inference_steps"),
+        "success": success,
+        "submitted_at": datetime.fromtimestamp(submitted).isoformat(timespec="seconds") if submitted else None,
+        "dispatcher_wait_s": _elapsed(timings, "submitted_at", "slot_acquired_at"),
+        "fal_queue_s": _elapsed(timings, "slot_acquired_at", "running_at"),
+        "inference_s": _elapsed(timings, "running_at", "finished_at"),
+        "total_s": _elapsed(timings, "submitted_at", "finished_at"),
+        "download_bytes": download_bytes,
+        "download_s": download_s,
+    }
+    record.update(extra)
+    return record
+
+
+async def measure_download(url: str) -> Tuple[Optional[int], Optional[float]]:
+    """Скачивает изображение и возвращает его размер и время скачивания."""
+    start = time.monotonic()
+    try:
+        data = await fetch_bytes(url)
+    except Exception as e:
+        logger.warning(f"Не удалось скачать результат прогона {url}: {e}")
+        return None, None
+    return len(data), round(time.monotonic() - start, 3)
+
+
+def build_report_csv(metrics: List[dict]) -> bytes:
+    """Формирует CSV-отчёт по метрикам (UTF-8 с BOM для Excel)."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=REPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for record in sorted(metrics, key=lambda r: r["number"]):
+        writer.writerow(record)
+    return buffer.getvalue().encode("utf-8-sig")
+
+
+def build_summary(metrics: List[dict]) -> str:
+    """Формирует сводную таблицу метрик прогона в Markdown."""
+    succeeded = [r for r in metrics if r["success"]]
+
+    def median(field: str, records: List[dict]) -> str:
+        values = [r[field] for r in records if r.get(field) is not None]
+        return f"{statistics.median(values):.1f}" if values else "—"
+
+    lines = [
+        "📊 *Метрики прогона*\n",
+        f"Успешно: {len(succeeded)} из {len(metrics)}",
+        f"Медианы: ожидание слота {median('dispatcher_wait_s', metrics)} с, "
+        f"очередь fal.ai {median('fal_queue_s', metrics)} с, "
+        f"инференс {median('inference_s', succeeded)} с, "
+        f"скачивание {median('download_s', succeeded)} с\n",
+    ]
+
+    by_steps: Dict[int, List[dict]] = {}
+    for record in metrics:
+        by_steps.setdefault(record["num_inference_steps"], []).append(record)
+
+    table = ["Шаги   N  Успех  Инференс  Всего  Размер"]
+    for steps in sorted(by_steps):
+        records = by_steps[steps]
+        ok = [r for r in records if r["success"]]
+        sizes = [r["download_bytes"] for r in ok if r.get("download_bytes")]
+        size = f"{statistics.mean(sizes) / 1024:.0f}K" if sizes else "—"
+        table.append(
+            f"{steps:>4} {len(records):>3} {len(ok) * 100 // len(records):>5}% "
+            f"{median('inference_s', ok):>8} {median('total_s', ok):>6} {size:>7}"
+        )
+    lines.append("```\n" + "\n".join(table) + "\n```")
+    return "\n".join(lines)
+
+
+# ─────────────────────────────────────────────
+# Хранилище заданий прогона
+# ─────────────────────────────────────────────
+
+_BENCHMARK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS benchmark_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    combinations TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'grid',
+    seed INTEGER,
+    status TEXT NOT NULL DEFAULT 'running',
+    status_message_id INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_benchmark_jobs_status ON benchmark_jobs(status);
+CREATE TABLE IF NOT EXISTS benchmark_results (
+    job_id INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    urls TEXT,
+    metrics TEXT,
+    sent INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, number)
+);
+"""
+
+# Колонки, добавленные после создания таблиц: (таблица, колонка, определение)
+_BENCHMARK_MIGRATIONS = [
+    ("benchmark_results", "sent", "INTEGER NOT NULL DEFAULT 0"),
+    ("benchmark_jobs", "kind", "TEXT NOT NULL DEFAULT 'grid'"),
+    ("benchmark_jobs", "seed", "INTEGER"),
+]
+
+
+class BenchmarkJobStore:
+    """
+    Задания прогона параметров в SQLite.
+
+    Вид задания: grid — перебор комбинаций (BenchmarkSweep), adaptive —
+    адаптивный поиск (AdaptiveSearch, для него хранится общий seed, а в
+    combinations — конфигурации первого этапа).
+
+    Статусы задания: running — выполняется или прервано перезапуском,
+    done — завершено, cancelled — остановлено пользователем, failed — ошибка.
+    Для каждой выполненной комбинации хранится список URL (NULL — ошибка генерации),
+    строка метрик для отчёта и признак sent — результат отправлен пользователю.
+    """
+
+    def __init__(self):
+        self._db: Optional[SQLiteDatabase] = None
+
+    @property
+    def db(self) -> SQLiteDatabase:
+        if self._db is None:
+            self._db = SQLiteDatabase(schema=_BENCHMARK_SCHEMA)
+            self._migrate(self._db)
+        return self._db
+
+    @staticmethod
+    def _migrate(db: SQLiteDatabase) -> None:
+        """Добавляет в таблицы, созданные прошлыми версиями бота, недостающие колонки."""
+        with db.lock, db.conn:
+            for table, column, definition in _BENCHMARK_MIGRATIONS:
+                columns = {row["name"] for row in db.conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    db.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def create(self, user_id: int, chat_id: int, prompt: str,
+               combinations: List[dict], status_message_id: Optional[int],
+               kind: str = "grid", seed: Optional[int] = None) -> int:
+        """Создаёт задание и возвращает его ID."""
+        now = time.time()
+        with self.db.lock, self.db.conn:
+            cursor = self.db.conn.execute(
+                "INSERT INTO benchmark_jobs (user_id, chat_id, prompt, combinations, kind, seed, "
+                "status_message_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, prompt, json.dumps(combinations), kind, seed, status_message_id, now, now),
+            )
+            return cursor.lastrowid
+
+    def record_result(self, job_id: int, number: int, urls: Optional[List[str]],
+                      metrics: Optional[dict] = None) -> None:
+        """Сохраняет результат комбинации."""
+        with self.db.lock, self.db.conn:
+            self.db.conn.execute(
+                "INSERT OR REPLACE INTO benchmark_results (job_id, number, urls, metrics) VALUES (?, ?, ?, ?)",
+                (job_id, number, json.dumps(urls) if urls else None, json.dumps(metrics) if metrics else None),
+            )
+            self.db.conn.execute(
+                "UPDATE benchmark_jobs SET updated_at = ? WHERE job_id = ?", (time.time(), job_id)
+            )
+
+    def mark_sent(self, job_id: int, numbers: List[int]) -> None:
+        """Отмечает результаты комбинаций как отправленные пользователю."""
+        with self.db.lock, self.db.conn:
+            self.db.conn.executemany(
+                "UPDATE benchmark_results SET sent = 1 WHERE job_id = ? AND number = ?",
+                [(job_id, number) for number in numbers],
+            )
+
+    def set_status(self, job_id: int, status: str) -> None:
+        """Обновляет статус задания."""
+        with self.db.lock, self.db.conn:
+            self.db.conn.execute(
+                "UPDATE benchmark_jobs SET status = ?, updated_at = ? WHERE job_id = ?",
+                (status, time.time(), job_id),
+            )
+
+    def set_status_message(self, job_id: int, message_id: int) -> None:
+        """Запоминает ID статусного сообщения задания."""
+        with self.db.lock, self.db.conn:
+            self.db.conn.execute(
+                "UPDATE benchmark_jobs SET status_message_id = ? WHERE job_id = ?",
+                (message_id, job_id),
+            )
+
+    def unfinished(self) -> List[dict]:
+        """Возвращает незавершённые задания вместе с уже полученными результатами."""
+        with self.db.lock:
+            jobs = self.db.conn.execute(
+                "SELECT * FROM benchmark_jobs WHERE status = 'running' ORDER BY job_id"
+            ).fetchall()
+            result = []
+            for job in jobs:
+                rows = self.db.conn.execute(
+                    "SELECT number, urls, metrics, sent FROM benchmark_results WHERE job_id = ?", (job["job_id"],)
+                ).fetchall()
+                result.append({
+                    "job_id": job["job_id"],
+                    "user_id": job["user_id"],
+                    "chat_id": job["chat_id"],
+                    "prompt": job["prompt"],
+                    "combinations": json.loads(job["combinations"]),
+                    "kind": job["kind"],
+                    "seed": job["seed"],
+                    "status_message_id": job["status_message_id"],
+                    "results": {
+                        row["number"]: json.loads(row["urls"]) if row["urls"] else None
+                        for row in rows
+                    },
+                    "metrics": [json.loads(row["metrics"]) for row in rows if row["metrics"]],
+                    "sent": [row["number"] for row in rows if row["sent"]],
+                })
+        return result
+
+
+# Единое хранилище заданий на процесс
+job_store = BenchmarkJobStore()
+
+
+# ─────────────────────────────────────────────
+# Прогон
+# ─────────────────────────────────────────────
+
+class BenchmarkSweep:
+    """
+    Параллельный прогон набора комбинаций параметров для одного промпта.
+
+    Номер комбинации — её позиция (с 1) в списке combinations, сохранённом
+    в задании; комбинации из results считаются выполненными и пропускаются.
+    Результаты, сохранённые, но не отправленные до остановки бота (не из sent),
+    отправляются в начале возобновлённого прогона.
+    """
+
+    KIND = "grid"
+
+    def __init__(self, bot, chat_id: int, user_id: int, prompt: str,
+                 combinations: List[dict], status_message_id: Optional[int] = None,
+                 job_id: Optional[int] = None,
+                 results: Optional[Dict[int, Optional[List[str]]]] = None,
+                 metrics: Optional[List[dict]] = None,
+                 sent: Optional[List[int]] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.combinations = combinations
+        self.status_message_id = status_message_id
+        self.job_id = job_id
+        self.seed: Optional[int] = None
+        self.cancelled_by_user = False
+
+        results = results or {}
+        self.total = len(combinations)
+        self.completed = len(results)
+        self.failed: List[int] = [number for number, urls in results.items() if not urls]
+        self._done = set(results)
+        self.metrics: List[dict] = list(metrics or [])
+
+        # Очередь отправки: (номер комбинации, URL, подпись)
+        self._album: List[tuple] = []
+        self._album_lock = asyncio.Lock()
+        self._last_status = 0.0
+
+        sent_numbers = set(sent or [])
+        for number, urls in sorted(results.items()):
+            if urls and number not in sent_numbers:
+                self._enqueue(number, urls)
+
+    def save(self) -> int:
+        """Создаёт задание прогона в хранилище."""
+        self.job_id = job_store.create(
+            self.user_id, self.chat_id, self.prompt, self.combinations, self.status_message_id,
+            kind=self.KIND, seed=self.seed,
+        )
+        return self.job_id
+
+    async def run(self) -> None:
+        """Выполняет прогон, отправляя результаты по мере готовности."""
+        logger.info(
+            f"Прогон параметров #{self.job_id} для user {self.user_id}: "
+            f"{self.total} комбинаций, уже выполнено {self.completed}"
+        )
+        semaphore = asyncio.Semaphore(BENCHMARK_CONCURRENCY)
+
+        async def worker(number: int, params: dict) -> None:
+            async with semaphore:
+                await self._run_combination(number, params)
+
+        try:
+            await self._flush_album()
+            await asyncio.gather(*(
+                worker(number, params)
+                for number, params in enumerate(self.combinations, 1)
+                if number not in self._done
+            ))
+            await self._flush_album(attempts=BENCHMARK_FLUSH_ATTEMPTS)
+            await self._set_job_status("done")
+            await self._send_report()
+            await self._set_status(
+                f"✅ *Прогон параметров завершен!*\n\n"
+                f"Было сгенерировано {self.completed - len(self.failed)} вариантов с разными параметрами."
+                f"{self._failed_text()}\n"
+                f"Выберите наиболее подходящую комбинацию параметров для своих задач."
+            )
+        except asyncio.CancelledError:
+            if not self.cancelled_by_user:
+                # Остановка бота: задание останется в статусе running и будет возобновлено
+                logger.info(f"Прогон параметров #{self.job_id} прерван остановкой бота на {self.completed}/{self.total}")
+                raise
+            logger.info(f"Прогон параметров user {self.user_id} отменён на {self.completed}/{self.total}")
+            await self._set_job_status("cancelled")
+            await self._flush_album(attempts=BENCHMARK_FLUSH_ATTEMPTS)
+            await self._send_report()
+            await self._set_status(
+                f"⛔ *Прогон параметров остановлен*\n\n"
+                f"Было выполнено {self.completed} из {self.total} итераций."
+                f"{self._failed_text()}"
+            )
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении прогона параметров: {e}")
+            await self._set_job_status("failed")
+            await self._set_status(
+                f"❌ *Произошла ошибка при выполнении прогона:*\n{str(e)[:100]}\n\n"
+                f"Было выполнено {self.completed} из {self.total} итераций."
+            )
+
+    async def _run_combination(self, number: int, params: dict) -> None:
+        """Генерирует одну комбинацию и ставит результат в очередь отправки."""
+        generation_params = BENCHMARK_SETTINGS.copy()
+        generation_params.update(params)
+
+        timings: dict = {}
+        image_urls = await generate_image_with_params(
+            self.prompt, generation_params, user_id=self.user_id, metrics=timings
+        )
+        download_bytes, download_s = (
+            await measure_download(image_urls[0]) if image_urls else (None, None)
+        )
+        record = combination_metrics(
+            number, generation_params, timings, bool(image_urls), download_bytes, download_s
+        )
+        self.metrics.append(record)
+        self.completed += 1
+        if self.job_id is not None:
+            await asyncio.to_thread(job_store.record_result, self.job_id, number, image_urls, record)
+
+        if not image_urls:
+            self.failed.append(number)
+        else:
+            self._enqueue(number, image_urls)
+            if len(self._album) >= MEDIA_GROUP_LIMIT:
+                await self._flush_album()
+
+        await self._maybe_update_status()
+
+    def _enqueue(self, number: int, image_urls: List[str]) -> None:
+        """Ставит изображения комбинации в очередь отправки."""
+        caption = (
+            f"🔍 *Результат прогона #{number}/{self.total}*\n\n"
+            f"{format_params(self.combinations[number - 1])}"
+        )
+        for url in image_urls:
+            self._album.append((number, url, caption))
+
+    async def _flush_album(self, attempts: int = 1) -> None:
+        """
+        Отправляет накопленные результаты альбомами.
+
+        Результаты убираются из очереди и отмечаются отправленными только
+        после успешной отправки своего альбома: при ошибке неотправленное
+        остаётся в очереди до следующего вызова, а прерванный остановкой
+        бота альбом будет отправлен после перезапуска.
+
+        Args:
+            attempts: Сколько раз пытаться отправить очередь (в конце прогона
+                следующего вызова не будет)
+        """
+        async with self._album_lock:
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(BENCHMARK_STATUS_INTERVAL)
+                try:
+                    while self._album:
+                        batch = self._album[:MEDIA_GROUP_LIMIT]
+                        await send_album(
+                            self.bot,
+                            self.chat_id,
+                            [url for _, url, _ in batch],
+                            captions=[caption for _, _, caption in batch],
+                            parse_mode="Markdown",
+                        )
+                        del self._album[:len(batch)]
+                        await self._mark_sent(batch)
+                    return
+                except Exception as e:
+                    logger.error(
+                        f"Ошибка отправки результатов прогона (попытка {attempt + 1}/{attempts}), "
+                        f"в очереди {len(self._album)} изображений: {e}"
+                    )
+
+    async def _mark_sent(self, batch: List[tuple]) -> None:
+        """Отмечает комбинации отправленного альбома в хранилище."""
+        if self.job_id is None:
+            return
+        numbers = sorted({number for number, _, _ in batch})
+        try:
+            await asyncio.to_thread(job_store.mark_sent, self.job_id, numbers)
+        except Exception as e:
+            logger.error(f"Не удалось отметить отправку результатов прогона #{self.job_id}: {e}")
+
+    async def _maybe_update_status(self) -> None:
+        """Обновляет статус не чаще BENCHMARK_STATUS_INTERVAL секунд."""
+        now = time.monotonic()
+        if now - self._last_status < BENCHMARK_STATUS_INTERVAL:
+            return
+        self._last_status = now
+        await self._set_status(
+            f"🔬 *Прогон параметров: {self.completed}/{self.total}*\n\n"
+            f"Одновременно генерируется до {BENCHMARK_CONCURRENCY} комбинаций."
+            f"{self._failed_text()}\n\n"
+            "⏳ Для остановки используйте /cancel"
+        )
+
+    async def _set_status(self, text: str) -> None:
+        """Редактирует статусное сообщение, игнорируя ошибки Telegram."""
+        if not self.status_message_id:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.status_message_id, parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус прогона: {e}")
+
+    async def _send_report(self) -> None:
+        """Отправляет сводную таблицу метрик и CSV-отчёт."""
+        if not self.metrics:
+            return
+        try:
+            await send_text(self.bot, self.chat_id, build_summary(self.metrics), parse_mode="Markdown")
+            report = build_report_csv(self.metrics)
+            await rate_limiter.wait(self.chat_id)
+            await self.bot.send_document(
+                chat_id=self.chat_id,
+                document=report,
+                filename=f"benchmark_{self.job_id or self.user_id}_{datetime.now():%Y%m%d_%H%M%S}.csv",
+                caption=f"📄 Метрики прогона: {len(self.metrics)} генераций",
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки отчёта прогона: {e}")
+
+    async def _set_job_status(self, status: str) -> None:
+        """Обновляет статус задания в хранилище."""
+        if self.job_id is None:
+            return
+        try:
+            await asyncio.to_thread(job_store.set_status, self.job_id, status)
+        except Exception as e:
+            logger.error(f"Не удалось обновить задание прогона #{self.job_id}: {e}")
+
+    def _failed_text(self) -> str:
+        if not self.failed:
+            return ""
+        numbers = ", ".join(f"#{n}" for n in sorted(self.failed)[:20])
+        more = "…" if len(self.failed) > 20 else ""
+        return f"\n⚠️ Ошибки генерации: {len(self.failed)} ({numbers}{more})"
+
+
+class AdaptiveSearch(BenchmarkSweep):
+    """
+    Адаптивный поиск параметров методом последовательного деления.
+
+    На первом этапе генерируется BENCHMARK_ADAPTIVE_INITIAL конфигураций
+    с минимальным числом шагов, каждая оценивается image_quality_score,
+    и на следующий этап (с большим числом шагов) переходит лучшая
+    1/BENCHMARK_ADAPTIVE_ETA часть. Все генерации используют один seed,
+    поэтому конфигурации сравниваются на одинаковом исходном шуме.
+
+    Поиск сохраняется как задание вида adaptive: конфигурации первого этапа,
+    seed и оценка каждой генерации. Номера генераций зависят только от этапа
+    и места конфигурации в нём, поэтому после перезапуска этапы повторяются
+    по сохранённым оценкам без новых генераций, а поиск продолжается с того
+    места, где был прерван.
+    """
+
+    KIND = "adaptive"
+
+    def __init__(self, bot, chat_id: int, user_id: int, prompt: str,
+                 status_message_id: Optional[int] = None,
+                 initial: int = BENCHMARK_ADAPTIVE_INITIAL, eta: int = BENCHMARK_ADAPTIVE_ETA,
+                 configs: Optional[List[dict]] = None, seed: Optional[int] = None,
+                 job_id: Optional[int] = None,
+                 results: Optional[Dict[int, Optional[List[str]]]] = None,
+                 metrics: Optional[List[dict]] = None,
+                 sent: Optional[List[int]] = None):
+        configs = unique_configs(configs or latin_hypercube(initial))
+        super().__init__(bot, chat_id, user_id, prompt, configs, status_message_id,
+                         job_id=job_id, metrics=metrics)
+        self.eta = max(2, eta)
+        self.steps = rung_steps(len(configs), self.eta)
+        self.seed = seed if seed is not None else random.randint(0, 2 ** 31 - 1)
+
+        # Сохранённые генерации: номер -> URL (None — ошибка) и оценка
+        self._stored = results or {}
+        self._scores = {
+            record["number"]: record["score"]
+            for record in self.metrics if record.get("score") is not None
+        }
+        self._sent = set(sent or [])
+        self.completed = len(self._stored)
+        self.failed = [number for number, urls in self._stored.items() if not urls]
+
+        # Плановое число генераций по всем этапам
+        self.total = 0
+        remaining = len(configs)
+        for _ in self.steps:
+            self.total += remaining
+            remaining = max(1, remaining // self.eta)
+
+        self.rung = 0
+        self.best: Optional[dict] = None
+
+    async def run(self) -> None:
+        """Выполняет поиск, отправляя результаты каждого этапа альбомом."""
+        logger.info(
+            f"Адаптивный поиск для user {self.user_id}: {len(self.combinations)} конфигураций, "
+            f"этапы по шагам {self.steps}, до {self.total} генераций"
+        )
+        semaphore = asyncio.Semaphore(BENCHMARK_CONCURRENCY)
+
+        async def evaluate(number: int, params: dict) -> Optional[dict]:
+            async with semaphore:
+                return await self._evaluate(number, params)
+
+        try:
+            configs = self.combinations
+            rung_start = 0
+            for self.rung, steps in enumerate(self.steps):
+                candidates = [dict(config, num_inference_steps=steps) for config in configs]
+                results = await asyncio.gather(*(
+                    evaluate(rung_start + i + 1, params)
+                    for i, params in enumerate(candidates)
+                ))
+                rung_start += len(candidates)
+                ranked = sorted((r for r in results if r), key=lambda r: r["score"], reverse=True)
+                if not ranked:
+                    raise RuntimeError("ни одна конфигурация этапа не сгенерирована")
+
+                self.best = ranked[0]
+                await self._send_rung(ranked, steps)
+
+                keep = max(1, len(ranked) // self.eta)
+                configs = unique_configs([r["params"] for r in ranked[:keep]])
+                if len(ranked) == 1:
+                    break
+
+            await self._set_job_status("done")
+            await self._send_report()
+            await self._set_status(
+                f"✅ *Адаптивный поиск завершен!*\n\n"
+                f"Выполнено генераций: {self.completed} (полный перебор — "
+                f"{len(BENCHMARK_PROMPT_STRENGTHS) * len(BENCHMARK_GUIDANCE_SCALES) * len(BENCHMARK_INFERENCE_STEPS)})."
+                f"{self._failed_text()}\n\n"
+                f"🏆 *Лучшая конфигурация:*\n{format_params(self.best['params'])}\n"
+                f"• Оценка резкости: {self.best['score']:.0f}"
+            )
+        except asyncio.CancelledError:
+            if not self.cancelled_by_user:
+                # Остановка бота: задание останется в статусе running и будет возобновлено
+                logger.info(f"Адаптивный поиск #{self.job_id} прерван остановкой бота на {self.completed}/{self.total}")
+                raise
+            logger.info(f"Адаптивный поиск user {self.user_id} остановлен на {self.completed}/{self.total}")
+            await self._set_job_status("cancelled")
+            best = f"\n\nЛучшая на данный момент:\n{format_params(self.best['params'])}" if self.best else ""
+            await self._send_report()
+            await self._set_status(
+                f"⛔ *Адаптивный поиск остановлен*\n\n"
+                f"Выполнено {self.completed} генераций.{best}"
+            )
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении адаптивного поиска: {e}")
+            await self._set_job_status("failed")
+            await self._set_status(
+                f"❌ *Произошла ошибка при выполнении поиска:*\n{str(e)[:100]}\n\n"
+                f"Было выполнено {self.completed} генераций."
+            )
+
+    async def _evaluate(self, number: int, params: dict) -> Optional[dict]:
+        """Генерирует конфигурацию и оценивает результат (или берёт сохранённый)."""
+        if number in self._stored:
+            urls = self._stored[number]
+            if not urls or number not in self._scores:
+                return None
+            return {"number": number, "params": params, "url": urls[0], "score": self._scores[number]}
+
+        generation_params = BENCHMARK_SETTINGS.copy()
+        generation_params.update(params)
+        generation_params["seed"] = self.seed
+
+        timings: dict = {}
+        image_urls = await generate_image_with_params(
+            self.prompt, generation_params, user_id=self.user_id, metrics=timings
+        )
+        self.completed += 1
+        record = combination_metrics(number, generation_params, timings, False, rung=self.rung + 1)
+        self.metrics.append(record)
+        try:
+            if not image_urls:
+                raise RuntimeError("пустой результат генерации")
+            start = time.monotonic()
+            data = await fetch_bytes(image_urls[0])
+            record.update(download_bytes=len(data), download_s=round(time.monotonic() - start, 3))
+            score = await asyncio.get_running_loop().run_in_executor(None, image_quality_score, data)
+            record.update(success=True, score=round(score, 1))
+        except Exception as e:
+            logger.error(f"Ошибка оценки конфигурации #{number} ({params}): {e}")
+            self.failed.append(number)
+            await self._record(number, None, record)
+            return None
+        finally:
+            await self._maybe_update_status()
+
+        await self._record(number, image_urls, record)
+        return {"number": number, "params": params, "url": image_urls[0], "score": score}
+
+    async def _record(self, number: int, image_urls: Optional[List[str]], record: dict) -> None:
+        """Сохраняет генерацию в задание."""
+        if self.job_id is None:
+            return
+        try:
+            await asyncio.to_thread(job_store.record_result, self.job_id, number, image_urls, record)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить генерацию #{number} поиска #{self.job_id}: {e}")
+
+    async def _send_rung(self, ranked: List[dict], steps: int) -> None:
+        """Отправляет результаты этапа, от лучшего к худшему (если ещё не отправлены)."""
+        numbers = [r["number"] for r in ranked]
+        if all(number in self._sent for number in numbers):
+            return
+        try:
+            await send_album(
+                self.bot,
+                self.chat_id,
+                [r["url"] for r in ranked],
+                captions=[
+                    f"🧭 *Этап {self.rung + 1}/{len(self.steps)}, место {place}*\n\n"
+                    f"{format_params(r['params'])}\n"
+                    f"• Оценка резкости: {r['score']:.0f}"
+                    for place, r in enumerate(ranked, 1)
+                ],
+                parse_mode="Markdown",
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки результатов этапа {self.rung + 1} ({steps} шагов): {e}")
+            return
+        self._sent.update(numbers)
+        if self.job_id is not None:
+            try:
+                await asyncio.to_thread(job_store.mark_sent, self.job_id, numbers)
+            except Exception as e:
+                logger.error(f"Не удалось отметить отправку этапа поиска #{self.job_id}: {e}")
+
+    async def _maybe_update_status(self) -> None:
+        """Обновляет статус не чаще BENCHMARK_STATUS_INTERVAL секунд."""
+        now = time.monotonic()
+        if now - self._last_status < BENCHMARK_STATUS_INTERVAL:
+            return
+        self._last_status = now
+        await self._set_status(
+            f"🧭 *Адаптивный поиск: этап {self.rung + 1}/{len(self.steps)} "
+            f"({self.steps[self.rung]} шагов)*\n\n"
+            f"Выполнено генераций: {self.completed} из {self.total}."
+            f"{self._failed_text()}\n\n"
+            "⏳ Для остановки используйте /cancel"
+        )
+
+
+def start_sweep(sweep: BenchmarkSweep) -> asyncio.Task:
+    """
+    Запускает прогон в фоновой задаче.
+
+    Задача создаётся напрямую в event loop, а не через Application.create_task:
+    иначе остановка бота ждала бы завершения всего прогона. Прерванный
+    остановкой прогон продолжится после перезапуска из сохранённого задания.
+    """
+    task = asyncio.get_running_loop().create_task(sweep.run())
+    task.sweep = sweep
+    active_sweeps[sweep.user_id] = task
+
+    def _on_done(t: asyncio.Task) -> None:
+        if active_sweeps.get(sweep.user_id) is t:
+            del active_sweeps[sweep.user_id]
+
+    task.add_done_callback(_on_done)
+    return task
+
+
+def is_sweep_running(user_id: int) -> bool:
+    """Проверяет, идёт ли у пользователя прогон параметров."""
+    task = active_sweeps.get(user_id)
+    return task is not None and not task.done()
+
+
+def cancel_sweep(user_id: int) -> bool:
+    """
+    Останавливает прогон параметров пользователя.
+
+    Returns:
+        True, если прогон был запущен и отменён
+    """
+    task: Optional[asyncio.Task] = active_sweeps.get(user_id)
+    if task is None or task.done():
+        return False
+    task.sweep.cancelled_by_user = True
+    task.cancel()
+    return True
+
+
+async def resume_sweeps(bot) -> int:
+    """
+    Возобновляет прогоны, прерванные перезапуском бота.
+
+    Returns:
+        Количество возобновлённых прогонов
+    """
+    jobs = await asyncio.to_thread(job_store.unfinished)
+    for job in jobs:
+        if job["kind"] == AdaptiveSearch.KIND:
+            sweep = AdaptiveSearch(
+                bot, job["chat_id"], job["user_id"], job["prompt"],
+                configs=job["combinations"], seed=job["seed"],
+                job_id=job["job_id"], results=job["results"], metrics=job["metrics"], sent=job["sent"],
+            )
+            title = "🧭 *Возобновляю адаптивный поиск после перезапуска*"
+        else:
+            sweep = BenchmarkSweep(
+                bot, job["chat_id"], job["user_id"], job["prompt"], job["combinations"],
+                job_id=job["job_id"], results=job["results"], metrics=job["metrics"], sent=job["sent"],
+            )
+            title = "🔬 *Возобновляю прогон параметров после перезапуска*"
+        try:
+            message = await send_text(
+                bot, job["chat_id"],
+                f"{title}\n\n"
+                f"Выполнено {sweep.completed} из {sweep.total} генераций, "
+                f"они не будут выполнены повторно.",
+                parse_mode="Markdown",
+            )
+            sweep.status_message_id = message.message_id
+            await asyncio.to_thread(job_store.set_status_message, sweep.job_id, message.message_id)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить статус возобновлённого прогона #{sweep.job_id}: {e}")
+
+        start_sweep(sweep)
+        logger.info(f"Возобновлён прогон параметров #{sweep.job_id} ({sweep.completed}/{sweep.total})")
+
+    return len(jobs)
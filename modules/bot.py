@@ -29,8 +29,15 @@ from modules.handlers import (
     generation_cycles_handler, handle_aspect_ratio_message, benchmark_prompt_handler,
     benchmark_options_handler, benchmark_count_handler,
     auto_confirm_prompt_handler,
-    photoshoot_command, photoshoot_schedule_handler
+    photoshoot_command, photoshoot_schedule_handler, stream_cancel_callback,
+    deliver_recovered_generation
 )
+from modules.settings import settings_store, flush_user_settings
+from modules.http_client import init_session, close_session
+from modules.update_processor import PerChatUpdateProcessor
+from modules.benchmark import resume_sweeps
+from modules.generation_jobs import recover_generation_jobs, KIND_GENERATION, KIND_PHOTOSHOOT
+from modules.scheduler import deliver_recovered_photoshoot, restore_scheduled_jobs
 
 warnings.filterwarnings('ignore')
 
@@ -47,6 +54,29 @@ def setup_logging():
     logger.info("Логирование настроено")
 
 
+async def post_init(application: Application) -> None:
+    """Выполняется после инициализации приложения, до начала polling."""
+    settings_store.load()
+    await init_session()
+
+    restore_scheduled_jobs(application)
+
+    resumed = await resume_sweeps(application.bot)
+    if resumed:
+        logger.info(f"Возобновлено прогонов параметров: {resumed}")
+
+    await recover_generation_jobs(application.bot, {
+        KIND_GENERATION: deliver_recovered_generation,
+        KIND_PHOTOSHOOT: deliver_recovered_photoshoot,
+    })
+
+
+async def post_shutdown(application: Application) -> None:
+    """Выполняется при остановке приложения."""
+    flush_user_settings()
+    await close_session()
+
+
 def main():
     """Основная функция для запуска бота."""
     try:
@@ -64,7 +94,14 @@ def main():
         else:
             logger.info("Бот запускается в публичном режиме.")
 
-        application = Application.builder().token(token).build()
+        application = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(PerChatUpdateProcessor())
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
 
         # ConversationHandler для настроек
         settings_conv_handler = ConversationHandler(
@@ -103,6 +140,8 @@ def main():
         application.add_handler(CommandHandler("help", help_command))
         application.add_handler(CommandHandler("cancel", cancel_command))
         application.add_handler(CommandHandler("photoshoot", photoshoot_command))
+        # Кнопка остановки генерации промпта доступна в любом состоянии диалога
+        application.add_handler(CallbackQueryHandler(stream_cancel_callback, pattern="^stream_cancel$"))
         application.add_handler(settings_conv_handler)
         application.add_handler(generation_conv_handler)
 
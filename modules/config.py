@@ -50,6 +50,12 @@ BENCHMARK_GUIDANCE_SCALES = [2.0, 2.5, 3.0, 3.5]
 BENCHMARK_INFERENCE_STEPS = list(range(20, 51, 5))  # От 20 до 50 с шагом 5
 MAX_BENCHMARK_ITERATIONS = 1500  # Максимально возможное количество итераций
 
+BENCHMARK_CONCURRENCY = int(os.getenv("BENCHMARK_CONCURRENCY", os.getenv("FAL_MAX_CONCURRENCY", "2")))  # Параллельных генераций в прогоне
+BENCHMARK_STATUS_INTERVAL = 5.0  # Минимальный интервал обновления статуса прогона (сек)
+BENCHMARK_FLUSH_ATTEMPTS = 3  # Попыток отправить оставшиеся результаты в конце прогона (между попытками — BENCHMARK_STATUS_INTERVAL)
+BENCHMARK_ADAPTIVE_INITIAL = 9  # Конфигураций на первом этапе адаптивного поиска
+BENCHMARK_ADAPTIVE_ETA = 3  # Во сколько раз сокращается число конфигураций на каждом этапе
+
 # Фиксированные настройки для режима прогона
 DEFAULT_INFERENCE_STEPS = 30
 DEFAULT_GUIDANCE_SCALE = 7.5
@@ -69,13 +75,23 @@ DEFAULT_NUM_OUTPUTS = 1  # Количество изображений в одн
 DEFAULT_ASPECT_RATIO = "1:1"  # Стандартное соотношение сторон
 DEFAULT_PROMPT_STRENGTH = 0.7  # Стандартная сила промпта
 DEFAULT_GENERATION_CYCLES = 1  # Количество циклов генерации
+GENERATION_FANOUT_LIMIT = int(os.getenv("GENERATION_FANOUT_LIMIT", "3"))  # Параллельных генераций циклов на пользователя
 DEFAULT_AUTO_CONFIRM_PROMPT = False  # Автоматическое подтверждение промпта (по умолчанию отключено)
 
+# Лимиты отправки сообщений Telegram
+TELEGRAM_CHAT_INTERVAL = 1.0  # Минимальный интервал между сообщениями в один чат (сек)
+TELEGRAM_GLOBAL_RATE = 30  # Максимум сообщений в секунду на бота
+PROMPT_STREAM_INTERVAL = 1.5  # Минимальный интервал обновления предпросмотра промпта (сек)
+GENERATION_STATUS_INTERVAL = 3.0  # Минимальный интервал обновления статуса очереди и генерации fal.ai (сек)
+
 # Доступные соотношения сторон
 ASPECT_RATIOS = ["1:1", "16:9", "9:16", "4:3", "3:4"]
 
 # Пути к файлам
 USER_SETTINGS_FILE = "user_settings.pkl"  # Файл для хранения пользовательских настроек
+BOT_DB_FILE = os.getenv("BOT_DB_FILE", "bot_data.db")  # База SQLite для настроек и служебных данных
+SETTINGS_BACKEND = os.getenv("SETTINGS_BACKEND", "sqlite")  # Хранилище настроек: sqlite или pickle
+SETTINGS_FLUSH_DELAY = float(os.getenv("SETTINGS_FLUSH_DELAY", "2.0"))  # Задержка фоновой записи настроек на диск (сек)
 
 # Настройки для моделей AI
 FLUX_MODEL_ID = "flux"  # Идентификатор модели FLUX
@@ -93,6 +109,21 @@ MAX_TOKENS = 16384  # Максимальное количество токено
 CONTEXT_WINDOW = 128000  # Максимальный размер контекстного окна в токенах
 TIMEOUT = 180  # Таймаут для запросов (в секундах)
 MAX_RETRIES = 3  # Максимальное количество повторных попыток при ошибке
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "6"))  # Одновременных скачиваний файлов
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))  # Попыток скачивания одного файла
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "8"))  # Соединений HTTP-клиента на один хост
+HTTP_DNS_CACHE_TTL = 300  # Время жизни DNS-кэша HTTP-клиента (сек)
+HTTP_MAX_DOWNLOAD_SIZE = int(os.getenv("HTTP_MAX_DOWNLOAD_SIZE", str(50 * 1024 * 1024)))  # Максимальный размер скачиваемого файла
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "90"))  # Таймаут одного запроса к Gemini (в секундах)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))  # Одновременных запросов к Gemini
+MEDIA_INLINE_LIMIT = int(os.getenv("MEDIA_INLINE_LIMIT", str(15 * 1024 * 1024)))  # Больше — медиа идёт через диск и Gemini Files API
+PHOTO_PROMPT_MODE = os.getenv("PHOTO_PROMPT_MODE", "single")  # Фото → промпт: single (один запрос) или two_step
+PROMPT_PREFETCH = os.getenv("PROMPT_PREFETCH", "0") == "1"  # Заранее генерировать альтернативный промпт на время подтверждения
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "512"))  # Промптов в памяти (LRU)
+PROMPT_CACHE_TTL = float(os.getenv("PROMPT_CACHE_TTL", str(7 * 24 * 3600)))  # Время жизни промпта в кэше (сек)
+PROMPT_CACHE_DISK = os.getenv("PROMPT_CACHE_DISK", "1") == "1"  # Хранить кэши ответов Gemini в SQLite
+IMAGE_ANALYSIS_CACHE_SIZE = int(os.getenv("IMAGE_ANALYSIS_CACHE_SIZE", "256"))  # Описаний изображений в памяти (LRU)
+IMAGE_ANALYSIS_CACHE_TTL = float(os.getenv("IMAGE_ANALYSIS_CACHE_TTL", str(30 * 24 * 3600)))  # Время жизни описания изображения (сек)
 
 # Стандартные настройки FLUX
 DEFAULT_SETTINGS = {
@@ -497,7 +528,17 @@ IMAGE_ANALYSIS_PROMPT = """
 FAL_MODEL_ID = os.getenv("FAL_MODEL_ID", "fal-ai/flux-2/lora")
 FAL_LORA_URL = os.getenv("FAL_LORA_URL", "")
 FAL_LORA_SCALE = float(os.getenv("FAL_LORA_SCALE", "1.0"))
-MAX_WAIT_TIME = int(os.getenv("MAX_WAIT_TIME", "300"))
+MAX_WAIT_TIME = int(os.getenv("MAX_WAIT_TIME", "300"))  # Максимальное ожидание результата fal.ai (сек)
+FAL_POLL_INTERVAL = float(os.getenv("FAL_POLL_INTERVAL", "1.0"))  # Интервал опроса статуса запроса fal.ai (сек)
+FAL_MAX_CONCURRENCY = int(os.getenv("FAL_MAX_CONCURRENCY", "2"))  # Лимит одновременных запросов аккаунта fal.ai
+GENERATION_RECOVERY_MAX_AGE = int(os.getenv("GENERATION_RECOVERY_MAX_AGE", str(6 * 3600)))  # Максимальный возраст запроса fal.ai, который забирается после перезапуска (сек)
+PHOTOSHOOT_DELIVERY_MODE = os.getenv("PHOTOSHOOT_DELIVERY_MODE", "url")  # Галерея фотосессии: url (Telegram скачивает сам) или upload
+ZIP_SPOOL_MAX_SIZE = 32 * 1024 * 1024  # Размер ZIP фотосессии, до которого он держится в памяти (байт)
+PHOTOSHOOT_WINDOW = int(os.getenv("PHOTOSHOOT_WINDOW", str(FAL_MAX_CONCURRENCY)))  # Генераций одной фотосессии в работе одновременно
+SCHEDULE_CATCHUP_GRACE = int(os.getenv("SCHEDULE_CATCHUP_GRACE", str(3 * 3600)))  # Сколько секунд после пропущенной (из-за остановки бота) фотосессии её ещё запускать
+PHOTOSHOOT_IMAGE_SECONDS = int(os.getenv("PHOTOSHOOT_IMAGE_SECONDS", "40"))  # Оценка времени генерации одного фото на fal.ai для плана расписания (сек)
+PHOTOSHOOT_PROMPT_SECONDS = int(os.getenv("PHOTOSHOOT_PROMPT_SECONDS", "30"))  # Оценка времени генерации промптов фотосессии в Gemini для плана расписания (сек)
+SCHEDULE_SPREAD = int(os.getenv("SCHEDULE_SPREAD", "3600"))  # На сколько секунд раньше или позже выбранного времени план может сдвинуть старт фотосессии
 
 # Настройки LoRA-персонажа
 TRIGGER_WORD = os.getenv("TRIGGER_WORD", "MLVNK")
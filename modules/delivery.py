@@ -0,0 +1,135 @@
+"""
+Модуль доставки результатов в Telegram.
+
+Группирует изображения в альбомы (send_media_group, до 10 фото) и
+выдерживает лимиты Telegram: не чаще 1 сообщения в секунду в один чат
+и не больше 30 сообщений в секунду на бота.
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from telegram import InputMediaPhoto
+
+from modules.config import (
+    TELEGRAM_CHAT_INTERVAL, TELEGRAM_GLOBAL_RATE, logger
+)
+
+MEDIA_GROUP_LIMIT = 10  # Максимум фото в одном альбоме Telegram
+CAPTION_LIMIT = 1024  # Максимальная длина подписи к фото
+
+
+class TelegramRateLimiter:
+    """
+    Ограничитель частоты отправки сообщений.
+
+    Каждый вызов резервирует момент отправки: не раньше чем через
+    TELEGRAM_CHAT_INTERVAL после предыдущей отправки в этот чат и не
+    чаще TELEGRAM_GLOBAL_RATE раз в секунду суммарно. Альбом резервирует
+    столько сообщений, сколько в нём фото: Telegram считает каждый элемент
+    альбома отдельным сообщением. Ожидание идёт без удержания блокировки,
+    поэтому разные чаты не ждут друг друга.
+    """
+
+    def __init__(self, chat_interval: float = TELEGRAM_CHAT_INTERVAL,
+                 global_rate: float = TELEGRAM_GLOBAL_RATE):
+        self._chat_interval = chat_interval
+        self._global_interval = 1.0 / global_rate
+        self._chat_next: Dict[int, float] = {}
+        self._global_next = 0.0
+
+    async def wait(self, chat_id: int, count: int = 1) -> None:
+        """
+        Ожидает, пока в чат можно отправить следующее сообщение.
+
+        Args:
+            chat_id: ID чата
+            count: Сколько сообщений резервируется (число фото в альбоме)
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        count = max(1, count)
+
+        # Глобальный слот резервируется от фактического момента отправки,
+        # иначе чат с задержкой занимал бы слот, который уже прошёл
+        start = max(now, self._chat_next.get(chat_id, now), self._global_next)
+        self._global_next = start + count * self._global_interval
+        self._chat_next[chat_id] = start + count * self._chat_interval
+
+        # Не даём словарю расти бесконечно
+        if len(self._chat_next) > 1000:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+        delay = start - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Единый ограничитель на процесс
+rate_limiter = TelegramRateLimiter()
+
+
+async def send_album(
+    bot,
+    chat_id: int,
+    photos: List[Any],
+    caption: Optional[str] = None,
+    parse_mode: Optional[str] = None,
+    captions: Optional[List[Optional[str]]] = None,
+    **kwargs,
+) -> list:
+    """
+    Отправляет изображения альбомами по 10 штук с учётом лимитов Telegram.
+
+    Подпись ставится на первое фото первого альбома. Одиночное фото
+    отправляется через send_photo, так как альбом требует минимум 2 элемента.
+
+    Args:
+        bot: Экземпляр telegram.Bot
+        chat_id: ID чата
+        photos: URL изображений или файловые объекты
+        caption: Подпись к альбому
+        parse_mode: Режим разметки подписи
+        captions: Отдельные подписи для каждого фото (вместо caption)
+
+    Returns:
+        Список отправленных сообщений
+    """
+    if captions is None:
+        captions = [caption] + [None] * (len(photos) - 1)
+
+    messages = []
+    for start in range(0, len(photos), MEDIA_GROUP_LIMIT):
+        chunk = photos[start:start + MEDIA_GROUP_LIMIT]
+        chunk_captions = captions[start:start + MEDIA_GROUP_LIMIT]
+
+        await rate_limiter.wait(chat_id, len(chunk))
+        if len(chunk) == 1:
+            message = await bot.send_photo(
+                chat_id=chat_id,
+                photo=chunk[0],
+                caption=chunk_captions[0],
+                parse_mode=parse_mode,
+                **kwargs,
+            )
+            messages.append(message)
+            continue
+
+        media = [
+            InputMediaPhoto(
+                media=photo,
+                caption=photo_caption,
+                parse_mode=parse_mode if photo_caption else None,
+            )
+            for photo, photo_caption in zip(chunk, chunk_captions)
+        ]
+        messages.extend(await bot.send_media_group(chat_id=chat_id, media=media, **kwargs))
+
+    logger.info(f"Отправлено {len(photos)} изображений в чат {chat_id}")
+    return messages
+
+
+async def send_text(bot, chat_id: int, text: str, **kwargs):
+    """Отправляет текстовое сообщение с учётом лимитов Telegram."""
+    await rate_limiter.wait(chat_id)
+    return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
@@ -0,0 +1,226 @@
+"""
+Модуль глобального диспетчера запросов к fal.ai.
+
+Все вызовы fal.ai в боте проходят через единый FalDispatcher, который
+держит не больше FAL_MAX_CONCURRENCY запросов одновременно (лимит аккаунта).
+Ожидающие запросы обслуживаются по приоритету (интерактивные → по расписанию
+→ прогон параметров), а внутри одного приоритета — по очереди между
+пользователями, чтобы одна большая фотосессия не блокировала остальных.
+
+Запрос ставится в очередь fal.ai через submit_async, статус опрашивается
+асинхронно (без потоков executor), а позиция в очереди и ход генерации
+передаются в callback для отображения пользователю.
+"""
+
+import asyncio
+import heapq
+import inspect
+import itertools
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional
+
+import fal_client
+
+from modules.config import (
+    FAL_MODEL_ID, FAL_MAX_CONCURRENCY, FAL_POLL_INTERVAL, MAX_WAIT_TIME, logger
+)
+
+# Приоритеты (меньше — важнее)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+PRIORITY_BENCHMARK = 2
+
+
+class SlotQueued:
+    """Статус запроса, ожидающего свободный слот в диспетчере бота."""
+
+    def __init__(self, ahead: int):
+        self.ahead = ahead
+
+    def __repr__(self) -> str:
+        return f"SlotQueued(ahead={self.ahead})"
+
+
+def describe_status(status: Any) -> Optional[str]:
+    """Возвращает понятное пользователю описание статуса запроса fal.ai."""
+    if isinstance(status, SlotQueued):
+        return f"⏳ Ожидание свободного слота генерации (запросов впереди: {status.ahead})"
+    if isinstance(status, fal_client.Queued):
+        return f"⏳ В очереди fal.ai: позиция {status.position + 1}"
+    if isinstance(status, fal_client.InProgress):
+        logs = [log.get("message", "") for log in (status.logs or []) if log.get("message")]
+        if logs:
+            return f"🎨 Идёт генерация...\n{logs[-1][:200]}"
+        return "🎨 Идёт генерация..."
+    if isinstance(status, fal_client.Completed):
+        return "📥 Генерация завершена, получаю результат..."
+    return None
+
+
+class FalDispatcher:
+    """
+    Семафор слотов fal.ai с приоритетной очередью и справедливостью между пользователями.
+
+    Элемент очереди упорядочивается по (приоритет, раунд пользователя, порядковый номер).
+    Раунд — сколько запросов этого пользователя уже стоит в очереди или выполняется
+    в момент постановки, поэтому пользователь с одним запросом обгоняет хвост
+    пачки другого пользователя того же приоритета.
+    """
+
+    def __init__(self, max_concurrency: int = FAL_MAX_CONCURRENCY):
+        self.max_concurrency = max(1, max_concurrency)
+        self._active = 0
+        self._queue: list = []
+        self._counter = itertools.count()
+        self._user_load: Dict[Any, int] = defaultdict(int)
+
+    @property
+    def active(self) -> int:
+        """Количество занятых слотов."""
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        """Количество запросов, ожидающих слот."""
+        return sum(1 for entry in self._queue if not entry[3].done())
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, user_id: Optional[int] = None) -> None:
+        """Ожидает свободный слот fal.ai."""
+        user_round = self._user_load[user_id]
+        self._user_load[user_id] += 1
+
+        if self._active < self.max_concurrency and not self.waiting:
+            self._active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, user_round, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но задачу отменили — отдаём его следующему
+                self._release_slot()
+            self._decrement_user(user_id)
+            raise
+
+    def release(self, user_id: Optional[int] = None) -> None:
+        """Освобождает слот fal.ai."""
+        self._decrement_user(user_id)
+        self._release_slot()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE, user_id: Optional[int] = None):
+        """Контекстный менеджер, удерживающий слот fal.ai на время запроса."""
+        await self.acquire(priority, user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    def _decrement_user(self, user_id: Optional[int]) -> None:
+        self._user_load[user_id] -= 1
+        if self._user_load[user_id] <= 0:
+            del self._user_load[user_id]
+
+    def _release_slot(self) -> None:
+        self._active -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        """Выдаёт освободившиеся слоты следующим в очереди."""
+        while self._active < self.max_concurrency and self._queue:
+            _, _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                # Ожидание было отменено
+                continue
+            self._active += 1
+            future.set_result(None)
+
+
+# Единый диспетчер на процесс
+fal_dispatcher = FalDispatcher()
+
+
+async def run_fal(
+    arguments: dict,
+    priority: int = PRIORITY_INTERACTIVE,
+    user_id: Optional[int] = None,
+    on_queue_update: Optional[Callable[[Any], Any]] = None,
+    metrics: Optional[dict] = None,
+    on_submitted: Optional[Callable[[str], Any]] = None,
+    durable: bool = False,
+) -> dict:
+    """
+    Выполняет запрос к модели fal.ai через глобальный диспетчер.
+
+    Args:
+        arguments: Аргументы модели FAL_MODEL_ID
+        priority: Приоритет запроса (PRIORITY_*)
+        user_id: ID пользователя Telegram для справедливого распределения слотов
+        on_queue_update: Callback статуса (обычная функция или корутина): SlotQueued
+            при ожидании слота бота, затем fal_client.Queued / InProgress / Completed
+        metrics: Словарь, в который записываются отметки времени (time.time()):
+            submitted_at — постановка в диспетчер, slot_acquired_at — получение слота,
+            running_at — начало инференса на fal.ai, finished_at — получение ответа
+        on_submitted: Callback с request_id запроса в очереди fal.ai
+        durable: Запрос сохранён в generation_jobs — при отмене задачи (остановке бота)
+            он не снимается с очереди fal.ai, и результат забирается после перезапуска
+
+    Returns:
+        Ответ fal.ai
+
+    Raises:
+        asyncio.TimeoutError: Если ответ не получен за MAX_WAIT_TIME секунд
+    """
+    async def notify(callback, value) -> None:
+        if callback is None:
+            return
+        try:
+            result = callback(value)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.warning(f"Ошибка в callback статуса fal.ai: {e}")
+
+    if metrics is not None:
+        metrics["submitted_at"] = time.time()
+
+    if fal_dispatcher.active >= fal_dispatcher.max_concurrency or fal_dispatcher.waiting:
+        await notify(on_queue_update, SlotQueued(fal_dispatcher.waiting))
+
+    async with fal_dispatcher.slot(priority, user_id):
+        if metrics is not None:
+            metrics["slot_acquired_at"] = time.time()
+        logger.info(
+            f"fal.ai слот получен (priority={priority}, user={user_id}, "
+            f"занято {fal_dispatcher.active}/{fal_dispatcher.max_concurrency}, в очереди {fal_dispatcher.waiting})"
+        )
+
+        handle = await fal_client.submit_async(FAL_MODEL_ID, arguments=arguments)
+        logger.info(f"fal.ai запрос поставлен в очередь: {handle.request_id}")
+        await notify(on_submitted, handle.request_id)
+
+        async def wait_result() -> dict:
+            async for status in handle.iter_events(with_logs=True, interval=FAL_POLL_INTERVAL):
+                if metrics is not None and isinstance(status, fal_client.InProgress):
+                    metrics.setdefault("running_at", time.time())
+                await notify(on_queue_update, status)
+            return await handle.get()
+
+        try:
+            return await asyncio.wait_for(wait_result(), timeout=MAX_WAIT_TIME)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if durable and isinstance(e, asyncio.CancelledError):
+                raise
+            # Снимаем запрос с очереди fal.ai, чтобы не платить за ненужный результат
+            try:
+                await handle.cancel()
+            except Exception as e:
+                logger.warning(f"Не удалось отменить запрос fal.ai {handle.request_id}: {e}")
+            raise
+        finally:
+            if metrics is not None:
+                metrics["finished_at"] = time.time()
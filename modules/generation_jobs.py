@@ -0,0 +1,258 @@
+"""
+Модуль сохранения запросов генерации fal.ai.
+
+Каждый запрос, поставленный в очередь fal.ai для генерации по запросу
+пользователя или фотосессии, записывается в SQLite вместе с чатом
+получателя и данными для подписи. Запись закрывается после доставки
+результата. Если бот перезапустился раньше, при старте он заново
+подключается к запросам fal.ai по request_id и отправляет готовые
+изображения, не ставя генерацию в очередь повторно.
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import fal_client
+
+from modules.config import (
+    FAL_MODEL_ID, MAX_WAIT_TIME, GENERATION_RECOVERY_MAX_AGE, logger
+)
+from modules.delivery import send_text
+from modules.storage import SQLiteDatabase
+
+# Виды заданий
+KIND_GENERATION = "generation"
+KIND_PHOTOSHOOT = "photoshoot"
+
+# Фоновые задачи восстановления (ссылки держатся до завершения)
+_recovery_tasks: set = set()
+
+_GENERATION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    request_id TEXT PRIMARY KEY,
+    group_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    user_id INTEGER,
+    chat_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs(status);
+"""
+
+
+class GenerationJobStore:
+    """
+    Запросы генерации fal.ai в SQLite.
+
+    Статусы: pending — результат ещё не доставлен, done — доставлен,
+    failed — генерация не удалась или запрос заменён повтором,
+    expired — запрос слишком старый, чтобы забирать его после перезапуска.
+    Запросы одной генерации (циклы, фото фотосессии) объединены group_id.
+    """
+
+    def __init__(self):
+        self._db: Optional[SQLiteDatabase] = None
+
+    @property
+    def db(self) -> SQLiteDatabase:
+        if self._db is None:
+            self._db = SQLiteDatabase(schema=_GENERATION_SCHEMA)
+        return self._db
+
+    def add(self, request_id: str, group_id: str, kind: str, user_id: Optional[int],
+            chat_id: int, payload: dict) -> None:
+        """Сохраняет запрос, поставленный в очередь fal.ai."""
+        now = time.time()
+        with self.db.lock, self.db.conn:
+            self.db.conn.execute(
+                "INSERT OR REPLACE INTO generation_jobs "
+                "(request_id, group_id, kind, user_id, chat_id, payload, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)",
+                (request_id, group_id, kind, user_id, chat_id, json.dumps(payload), now, now),
+            )
+
+    def set_status(self, request_ids: List[str], status: str) -> None:
+        """Обновляет статус запросов."""
+        if not request_ids:
+            return
+        now = time.time()
+        with self.db.lock, self.db.conn:
+            self.db.conn.executemany(
+                "UPDATE generation_jobs SET status = ?, updated_at = ? WHERE request_id = ?",
+                [(status, now, request_id) for request_id in request_ids],
+            )
+
+    def pending(self, max_age: float = GENERATION_RECOVERY_MAX_AGE) -> List[dict]:
+        """
+        Возвращает недоставленные запросы не старше max_age секунд.
+
+        Более старые недоставленные запросы помечаются expired, а закрытые
+        записи старше max_age удаляются.
+        """
+        cutoff = time.time() - max_age
+        with self.db.lock, self.db.conn:
+            self.db.conn.execute(
+                "UPDATE generation_jobs SET status = 'expired', updated_at = ? "
+                "WHERE status = 'pending' AND created_at < ?",
+                (time.time(), cutoff),
+            )
+            self.db.conn.execute(
+                "DELETE FROM generation_jobs WHERE status != 'pending' AND updated_at < ?", (cutoff,)
+            )
+            rows = self.db.conn.execute(
+                "SELECT * FROM generation_jobs WHERE status = 'pending' ORDER BY created_at"
+            ).fetchall()
+        return [
+            {
+                "request_id": row["request_id"],
+                "group_id": row["group_id"],
+                "kind": row["kind"],
+                "user_id": row["user_id"],
+                "chat_id": row["chat_id"],
+                "payload": json.loads(row["payload"]),
+            }
+            for row in rows
+        ]
+
+
+# Единое хранилище запросов на процесс
+generation_store = GenerationJobStore()
+
+
+class JobTracker:
+    """
+    Записывает запросы fal.ai одной генерации в generation_jobs.
+
+    Каждый запрос генерации привязан к ключу (номер цикла, индекс фото).
+    Если под тем же ключом ставится повторный запрос, предыдущий помечается
+    failed, чтобы после перезапуска не доставлять неудачную попытку.
+    """
+
+    def __init__(self, kind: str, user_id: Optional[int], chat_id: int, **payload):
+        self.kind = kind
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.payload = payload
+        self.group_id = uuid.uuid4().hex
+        self._requests: Dict[Any, str] = {}
+
+    def callback(self, key: Any, **payload) -> Callable[[str], Awaitable[None]]:
+        """Возвращает callback on_submitted для run_fal, сохраняющий запрос под ключом key."""
+        async def on_submitted(request_id: str) -> None:
+            previous = self._requests.get(key)
+            self._requests[key] = request_id
+            try:
+                if previous:
+                    await asyncio.to_thread(generation_store.set_status, [previous], "failed")
+                await asyncio.to_thread(
+                    generation_store.add, request_id, self.group_id, self.kind,
+                    self.user_id, self.chat_id, {**self.payload, **payload},
+                )
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить запрос fal.ai {request_id}: {e}")
+
+        return on_submitted
+
+    async def finish(self, status: str = "done", key: Any = None) -> None:
+        """Закрывает запрос под ключом key (по умолчанию — все запросы генерации)."""
+        if key is None:
+            request_ids = list(self._requests.values())
+            self._requests.clear()
+        else:
+            request_id = self._requests.pop(key, None)
+            request_ids = [request_id] if request_id else []
+        try:
+            await asyncio.to_thread(generation_store.set_status, request_ids, status)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус запросов fal.ai {request_ids}: {e}")
+
+
+# ─────────────────────────────────────────────
+# Восстановление после перезапуска
+# ─────────────────────────────────────────────
+
+async def _fetch_result(request_id: str) -> Optional[List[str]]:
+    """Дожидается результата запроса fal.ai по request_id, возвращает URL изображений."""
+    try:
+        result = await asyncio.wait_for(
+            fal_client.result_async(FAL_MODEL_ID, request_id), timeout=MAX_WAIT_TIME
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось получить результат запроса fal.ai {request_id}: {e}")
+        return None
+    urls = [image["url"] for image in result.get("images", [])]
+    return urls or None
+
+
+async def _recover_group(bot, jobs: List[dict], deliver) -> None:
+    """Забирает результаты запросов одной генерации и доставляет их в чат."""
+    chat_id = jobs[0]["chat_id"]
+    request_ids = [job["request_id"] for job in jobs]
+    results = await asyncio.gather(*(_fetch_result(request_id) for request_id in request_ids))
+    entries = [(job["payload"], urls) for job, urls in zip(jobs, results) if urls]
+
+    status = "failed"
+    try:
+        if entries:
+            await deliver(bot, chat_id, entries)
+            status = "done"
+        else:
+            await send_text(
+                bot, chat_id,
+                "⚠️ Генерация, начатая до перезапуска бота, не завершилась. Пожалуйста, повторите запрос."
+            )
+    except Exception as e:
+        logger.error(f"Ошибка доставки восстановленной генерации в чат {chat_id}: {e}")
+    finally:
+        await asyncio.to_thread(generation_store.set_status, request_ids, status)
+
+    logger.info(
+        f"Восстановлена генерация {jobs[0]['group_id']} ({jobs[0]['kind']}): "
+        f"получено {len(entries)} из {len(jobs)} результатов"
+    )
+
+
+async def recover_generation_jobs(bot, deliverers: Dict[str, Callable[..., Awaitable[None]]]) -> int:
+    """
+    Подключается к запросам fal.ai, прерванным перезапуском бота, и доставляет результаты.
+
+    Запросы не ставятся в очередь повторно: результат забирается по
+    сохранённому request_id, в том числе если генерация ещё идёт. Ожидание
+    выполняется в фоновых задачах, чтобы не задерживать запуск бота, и
+    мимо диспетчера слотов — эти запросы уже выполняются на стороне fal.ai.
+
+    Args:
+        bot: Экземпляр telegram.Bot
+        deliverers: Функции доставки по виду задания:
+            async (bot, chat_id, [(payload, urls), ...])
+
+    Returns:
+        Количество восстанавливаемых генераций
+    """
+    jobs = await asyncio.to_thread(generation_store.pending)
+
+    groups: "OrderedDict[str, List[dict]]" = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job["group_id"], []).append(job)
+
+    loop = asyncio.get_running_loop()
+    for group_id, group in groups.items():
+        deliver = deliverers.get(group[0]["kind"])
+        if deliver is None:
+            logger.warning(f"Неизвестный вид генерации {group[0]['kind']} ({group_id}), пропускаю")
+            await asyncio.to_thread(generation_store.set_status, [j["request_id"] for j in group], "failed")
+            continue
+        task = loop.create_task(_recover_group(bot, group, deliver))
+        _recovery_tasks.add(task)
+        task.add_done_callback(_recovery_tasks.discard)
+
+    if groups:
+        logger.info(f"Восстанавливаю {len(groups)} генераций ({len(jobs)} запросов fal.ai) после перезапуска")
+    return len(groups)
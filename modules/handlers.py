@@ -3,8 +3,12 @@
 """
 
 import os
+import random
 import tempfile
+import time
 import asyncio
+import weakref
+from contextlib import asynccontextmanager
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 
@@ -12,25 +16,33 @@ from modules.config import (
     AWAITING_CONFIRMATION, SETTINGS,
     SETTING_NUM_OUTPUTS, SETTING_ASPECT_RATIO, SETTING_PROMPT_STRENGTH,
     SETTING_GEMINI_MODEL, SETTING_GENERATION_CYCLES, SETTING_AUTO_CONFIRM_PROMPT,
-    SETTING_PHOTOSHOOT_SCHEDULE,
+    SETTING_PHOTOSHOOT_SCHEDULE, SCHEDULE_SPREAD,
     ASPECT_RATIOS, GEMINI_MODELS,
     logger, AUTHORIZED_USERS, BOT_PRIVATE,
-    AWAITING_BENCHMARK_PROMPT, BENCHMARK_SETTINGS, BENCHMARK_PROMPT_STRENGTHS,
+    AWAITING_BENCHMARK_PROMPT, BENCHMARK_PROMPT_STRENGTHS,
     BENCHMARK_GUIDANCE_SCALES, BENCHMARK_INFERENCE_STEPS, MAX_BENCHMARK_ITERATIONS,
-    AWAITING_BENCHMARK_OPTIONS, AWAITING_BENCHMARK_COUNT
+    AWAITING_BENCHMARK_OPTIONS, AWAITING_BENCHMARK_COUNT, GENERATION_FANOUT_LIMIT,
+    MEDIA_INLINE_LIMIT, PHOTO_PROMPT_MODE, PROMPT_STREAM_INTERVAL, PROMPT_PREFETCH,
+    GENERATION_STATUS_INTERVAL
 )
 from modules.settings import (
     get_user_settings, update_user_settings, reset_user_settings
 )
 from modules.ai_services import (
-    generate_prompt, analyze_image, transcribe_audio,
-    analyze_image_content, generate_image, download_file,
-    generate_image_with_params
+    generate_prompt, analyze_image, transcribe_audio, get_cached_image_description,
+    analyze_image_content, analyze_photo, generate_image, download_file
 )
 from modules.photoshoot import run_photoshoot
+from modules.fal_dispatcher import describe_status
+from modules.generation_jobs import JobTracker, KIND_GENERATION
+from modules.delivery import send_album, send_text, CAPTION_LIMIT
+from modules.benchmark import (
+    BenchmarkSweep, AdaptiveSearch, build_combinations, start_sweep, cancel_sweep,
+    is_sweep_running
+)
 from modules.scheduler import (
     get_schedule, update_schedule, format_schedule,
-    send_photoshoot_result, setup_scheduled_jobs, remove_scheduled_jobs,
+    send_photoshoot_result, reschedule_photoshoots, remove_scheduled_jobs,
     DAY_NAMES
 )
 
@@ -134,6 +146,14 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_authorization(update):
         await send_unauthorized_message(update)
         return ConversationHandler.END
+    
+    # Останавливаем фоновый прогон параметров, если он запущен
+    if cancel_sweep(update.effective_user.id):
+        await update.message.reply_text("⛔ Прогон параметров остановлен.")
+
+    # Останавливаем генерацию промпта, если она идёт
+    cancel_prompt_stream(update.effective_user.id)
+    cancel_prompt_prefetch(update.effective_user.id)
         
     await update.message.reply_text("Все текущие операции отменены. Вы можете начать снова.")
     return ConversationHandler.END
@@ -796,6 +816,316 @@ async def auto_confirm_prompt_handler(update: Update, context: ContextTypes.DEFA
 # Обработчики пользовательских запросов
 # =================================================================
 
+async def send_cycle_result(bot, chat_id: int, image_urls, prompt: str, cycle: int = 1, cycles: int = 1):
+    """Отправляет изображения цикла генерации одним альбомом с промптом в подписи."""
+    cycle_text = f" (цикл {cycle}/{cycles})" if cycles > 1 else ""
+    header = f"Использованный промпт{cycle_text}:\n"
+
+    # Обрезаем промпт, чтобы подпись уместилась в лимит Telegram
+    max_prompt_length = CAPTION_LIMIT - len(header) - 5
+    prompt_display = prompt if len(prompt) <= max_prompt_length else prompt[:max_prompt_length - 3] + "..."
+
+    await send_album(
+        bot,
+        chat_id,
+        image_urls,
+        caption=f"{header}`{prompt_display}`",
+        parse_mode="Markdown",
+        read_timeout=30,
+        write_timeout=30
+    )
+
+async def deliver_recovered_generation(bot, chat_id: int, entries) -> None:
+    """Отправляет результаты генерации, прерванной перезапуском бота (см. generation_jobs)."""
+    await send_text(bot, chat_id, "♻️ Результаты генерации, прерванной перезапуском бота:")
+    for payload, image_urls in sorted(entries, key=lambda entry: entry[0].get("cycle", 1)):
+        await send_cycle_result(
+            bot, chat_id, image_urls, payload["prompt"],
+            payload.get("cycle", 1), payload.get("cycles", 1),
+        )
+
+# Ограничение параллельных генераций fal.ai на одного пользователя. Семафор
+# живёт, пока его держит хотя бы одна генерация, затем удаляется из словаря
+_user_fanout_limits: "weakref.WeakValueDictionary[int, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+
+def _get_user_fanout(user_id: int) -> asyncio.Semaphore:
+    """Возвращает семафор параллельных генераций пользователя."""
+    semaphore = _user_fanout_limits.get(user_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(GENERATION_FANOUT_LIMIT)
+        _user_fanout_limits[user_id] = semaphore
+    return semaphore
+
+
+async def _regenerate_prompt(user_request: str, request_type: str, user_id: int, on_partial=None):
+    """Генерирует новый промпт по исходному запросу в обход кэша, чтобы варианты различались."""
+    if request_type == "image":
+        return await analyze_image(user_request, user_id, use_cache=False, on_partial=on_partial)
+    return await generate_prompt(user_request, user_id, use_cache=False, on_partial=on_partial)
+
+
+# Заранее сгенерированные альтернативные промпты: user_id -> (запрос, задача)
+_prompt_prefetch = {}
+
+
+def start_prompt_prefetch(user_id: int, user_request: str, request_type: str) -> None:
+    """
+    Начинает фоновую генерацию альтернативного промпта, пока пользователь решает.
+
+    Результат используется при «Повторить» (показывается сразу) или как промпт
+    второго цикла генерации. Включается настройкой PROMPT_PREFETCH.
+    """
+    if not PROMPT_PREFETCH or not user_request:
+        return
+    cancel_prompt_prefetch(user_id)
+    task = asyncio.create_task(_regenerate_prompt(user_request, request_type, user_id))
+    _prompt_prefetch[user_id] = (user_request, task)
+
+
+def take_prompt_prefetch(user_id: int, user_request: str):
+    """
+    Забирает фоновую генерацию промпта пользователя.
+
+    Returns:
+        Задача генерации или None, если её нет или она начата для другого запроса
+    """
+    entry = _prompt_prefetch.pop(user_id, None)
+    if entry is None:
+        return None
+    request, task = entry
+    if request != user_request:
+        task.cancel()
+        return None
+    return task
+
+
+def cancel_prompt_prefetch(user_id: int) -> None:
+    """Отменяет фоновую генерацию промпта пользователя."""
+    entry = _prompt_prefetch.pop(user_id, None)
+    if entry is not None:
+        entry[1].cancel()
+
+
+async def _await_prefetch(task):
+    """
+    Ожидает фоновую генерацию промпта; возвращает None, если отменена она сама.
+
+    Ожидание идёт через asyncio.shield, чтобы отличить отмену фоновой задачи
+    (возвращается None) от отмены вызывающей корутины (отмена пробрасывается
+    дальше, а ненужная больше генерация промпта останавливается).
+    """
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        current = asyncio.current_task()
+        if not task.cancelled() or (current is not None and current.cancelling()):
+            task.cancel()
+            raise
+        return None
+
+
+class GenerationStatus:
+    """
+    Показывает позицию в очереди и ход генерации fal.ai в статусном сообщении.
+
+    Сообщение редактируется не чаще GENERATION_STATUS_INTERVAL.
+    """
+
+    def __init__(self, message, title: str):
+        self.message = message
+        self.title = title
+        self._last_text = None
+        self._last_edit = 0.0
+
+    async def __call__(self, status) -> None:
+        text = describe_status(status)
+        now = time.monotonic()
+        if not text or text == self._last_text or now - self._last_edit < GENERATION_STATUS_INTERVAL:
+            return
+        self._last_text = text
+        self._last_edit = now
+        await self.message.edit_text(f"{self.title}\n\n{text}")
+
+
+# Генерации промптов с предпросмотром: user_id -> задача
+_prompt_streams = {}
+
+# Сколько последних символов промпта показывать в предпросмотре
+PROMPT_PREVIEW_LIMIT = 3500
+
+
+class PromptPreview:
+    """Показывает промпт по мере генерации, редактируя сообщение не чаще PROMPT_STREAM_INTERVAL."""
+
+    def __init__(self, message, header: str):
+        self.message = message
+        self.header = header
+        self._last_edit = 0.0
+        self._keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⛔ Остановить", callback_data="stream_cancel")]
+        ])
+
+    async def __call__(self, text: str) -> None:
+        now = time.monotonic()
+        if now - self._last_edit < PROMPT_STREAM_INTERVAL:
+            return
+        self._last_edit = now
+        preview = text if len(text) <= PROMPT_PREVIEW_LIMIT else "…" + text[-PROMPT_PREVIEW_LIMIT:]
+        await self.message.edit_text(f"{self.header}\n\n{preview}", reply_markup=self._keyboard)
+
+
+async def stream_prompt(message, user_id: int, generate, header: str = "✍️ Генерирую промпт..."):
+    """
+    Генерирует промпт с живым предпросмотром в сообщении.
+
+    Пока идёт генерация, под предпросмотром есть кнопка остановки
+    (callback_data="stream_cancel"); её нажатие или /cancel прерывает
+    запрос к Gemini. Ошибку и остановку функция сообщает сама.
+
+    Args:
+        message: Сообщение статуса
+        user_id: ID пользователя
+        generate: Функция, принимающая callback предпросмотра и возвращающая корутину генерации
+        header: Заголовок предпросмотра
+
+    Returns:
+        Промпт или None при ошибке или остановке
+    """
+    task = asyncio.create_task(generate(PromptPreview(message, header)))
+    _prompt_streams[user_id] = task
+    try:
+        prompt = await task
+    except asyncio.CancelledError:
+        if not getattr(task, "stopped_by_user", False):
+            raise
+        logger.info(f"Генерация промпта остановлена пользователем {user_id}")
+        await message.edit_text("⛔ Генерация промпта остановлена.")
+        return None
+    finally:
+        if _prompt_streams.get(user_id) is task:
+            del _prompt_streams[user_id]
+
+    if not prompt:
+        await message.edit_text("Произошла ошибка при создании промпта. Пожалуйста, попробуйте позже.")
+    return prompt
+
+
+def cancel_prompt_stream(user_id: int) -> bool:
+    """
+    Останавливает генерацию промпта пользователя.
+
+    Returns:
+        True, если генерация шла и была остановлена
+    """
+    task = _prompt_streams.get(user_id)
+    if task is None or task.done():
+        return False
+    task.stopped_by_user = True
+    task.cancel()
+    return True
+
+
+async def stream_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает кнопку остановки генерации промпта."""
+    query = update.callback_query
+    if cancel_prompt_stream(query.from_user.id):
+        await query.answer("Останавливаю генерацию...")
+    else:
+        await query.answer("Генерация уже завершена")
+
+
+async def run_generation_cycles(bot, chat_id: int, user_id: int, status_message, prompt: str,
+                                user_request: str, request_type: str, cycles: int,
+                                prefetched=None) -> int:
+    """
+    Выполняет циклы генерации изображений и отправляет результаты.
+
+    Промпты циклов 2..N генерируются параллельно, генерации fal.ai запускаются
+    по готовности промптов (не больше GENERATION_FANOUT_LIMIT одновременно на
+    пользователя), а результаты отправляются в чат по мере готовности.
+    Заранее сгенерированный промпт (prefetched) используется во втором цикле.
+    Запросы fal.ai сохраняются в generation_jobs до отправки результата.
+
+    Returns:
+        Количество успешно выполненных циклов
+    """
+    if prefetched is not None and cycles <= 1:
+        prefetched.cancel()
+
+    tracker = JobTracker(KIND_GENERATION, user_id, chat_id, cycles=cycles)
+
+    if cycles <= 1:
+        title = "🎨 Генерирую изображение (это может занять до 3 минут)..."
+        await status_message.edit_text(title)
+        image_urls = await generate_image(
+            prompt, user_id,
+            on_status=GenerationStatus(status_message, title),
+            on_submitted=tracker.callback(1, prompt=prompt, cycle=1),
+        )
+        if not image_urls:
+            await tracker.finish("failed")
+            await status_message.edit_text("Произошла ошибка при генерации изображения. Пожалуйста, попробуйте позже.")
+            return 0
+        try:
+            await send_cycle_result(bot, chat_id, image_urls, prompt)
+        except Exception:
+            await tracker.finish("failed")
+            raise
+        await tracker.finish()
+        return 1
+
+    fanout = _get_user_fanout(user_id)
+    finished = 0
+    succeeded = 0
+
+    async def update_status():
+        try:
+            await status_message.edit_text(
+                f"🎨 Генерирую {cycles} вариантов параллельно (это может занять до 3 минут)...\n"
+                f"Готово: {finished}/{cycles}"
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус генерации: {e}")
+
+    async def run_cycle(cycle: int):
+        nonlocal finished, succeeded
+        try:
+            if cycle == 1:
+                cycle_prompt = prompt
+            else:
+                cycle_prompt = await _await_prefetch(prefetched) if cycle == 2 and prefetched is not None else None
+                if not cycle_prompt:
+                    cycle_prompt = await _regenerate_prompt(user_request, request_type, user_id)
+            if not cycle_prompt:
+                logger.error(f"Ошибка при генерации промпта в цикле {cycle}")
+                return
+
+            async with fanout:
+                image_urls = await generate_image(
+                    cycle_prompt, user_id,
+                    on_submitted=tracker.callback(cycle, prompt=cycle_prompt, cycle=cycle),
+                )
+            if not image_urls:
+                logger.error(f"Ошибка при генерации изображения в цикле {cycle}")
+                await tracker.finish("failed", key=cycle)
+                return
+
+            await send_cycle_result(bot, chat_id, image_urls, cycle_prompt, cycle, cycles)
+            await tracker.finish(key=cycle)
+            succeeded += 1
+        except Exception as e:
+            logger.error(f"Ошибка в цикле генерации {cycle}: {e}")
+            await tracker.finish("failed", key=cycle)
+        finally:
+            finished += 1
+            await update_status()
+
+    await update_status()
+    await asyncio.gather(*(run_cycle(cycle) for cycle in range(1, cycles + 1)))
+    return succeeded
+
+
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает текстовые сообщения."""
     # Проверяем авторизацию
@@ -814,10 +1144,13 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Получаем ID пользователя для использования выбранной модели
         user_id = update.effective_user.id
         
-        # Генерируем промпт через Gemini
-        prompt = await generate_prompt(update.message.text, user_id)
+        # Генерируем промпт через Gemini, показывая его по мере генерации
+        text = update.message.text
+        prompt = await stream_prompt(
+            message, user_id,
+            lambda on_partial: generate_prompt(text, user_id, on_partial=on_partial)
+        )
         if not prompt:
-            await message.edit_text("Произошла ошибка при создании промпта. Пожалуйста, попробуйте позже.")
             return ConversationHandler.END
         
         # Сохраняем промпт в контексте
@@ -830,6 +1163,39 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         await message.edit_text("Произошла непредвиденная ошибка. Пожалуйста, попробуйте позже.")
         return ConversationHandler.END
 
+@asynccontextmanager
+async def telegram_media(media, suffix: str):
+    """
+    Загружает файл из Telegram для передачи в AI-сервисы.
+
+    Файлы до MEDIA_INLINE_LIMIT скачиваются прямо в память и отдаются как bytes.
+    Большие файлы сохраняются во временный файл, и отдаётся путь к нему;
+    файл удаляется при выходе из контекста, в том числе при ошибке.
+
+    Args:
+        media: Объект Telegram с методом get_file (Voice, PhotoSize и т.п.)
+        suffix: Расширение временного файла
+    """
+    tg_file = await media.get_file()
+    if (media.file_size or 0) <= MEDIA_INLINE_LIMIT:
+        data = await tg_file.download_as_bytearray()
+        logger.info(f"Файл {media.file_unique_id} загружен в память: {len(data)} байт")
+        yield bytes(data)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
+        path = temp_file.name
+    try:
+        await tg_file.download_to_drive(path)
+        logger.info(f"Большой файл {media.file_unique_id} сохранен во временный файл: {path}")
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить временный файл {path}: {e}")
+
+
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает голосовые сообщения."""
     # Проверяем авторизацию
@@ -850,38 +1216,10 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
             await message.edit_text("⚠️ Голосовое сообщение слишком длинное. Пожалуйста, отправьте сообщение длительностью до 60 секунд.")
             return ConversationHandler.END
         
-        # Получаем файл с голосовым сообщением
-        voice_file = await update.message.voice.get_file()
-        
-        # Создаем временный файл для сохранения голосового сообщения
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_voice:
-            voice_path = temp_voice.name
-        
-        # Загружаем голосовое сообщение
-        await voice_file.download_to_drive(voice_path)
-        logger.info(f"Голосовое сообщение сохранено во временный файл: {voice_path}")
-        
-        # Проверяем, что файл существует и не пустой
-        if not os.path.exists(voice_path) or os.path.getsize(voice_path) == 0:
-            logger.error(f"Проблема с сохранением голосового сообщения: файл не создан или пустой")
-            await message.edit_text("Произошла ошибка при сохранении голосового сообщения. Пожалуйста, попробуйте снова.")
-            
-            # Попытка удаления временного файла, если он существует
-            if os.path.exists(voice_path):
-                os.remove(voice_path)
-                
-            return ConversationHandler.END
-        
-        # Транскрибируем голосовое сообщение
-        await message.edit_text("🎤 Распознаю речь...")
-        transcription = await transcribe_audio(voice_path)
-        
-        # Удаляем временный файл
-        try:
-            os.remove(voice_path)
-            logger.info(f"Временный файл удален: {voice_path}")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временный файл: {e}")
+        # Загружаем голосовое сообщение и транскрибируем его
+        async with telegram_media(update.message.voice, ".ogg") as voice:
+            await message.edit_text("🎤 Распознаю речь...")
+            transcription = await transcribe_audio(voice)
         
         if not transcription:
             await message.edit_text("⚠️ Не удалось распознать голосовое сообщение. Пожалуйста, попробуйте снова или отправьте текстовый запрос.")
@@ -898,9 +1236,12 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
         user_id = update.effective_user.id
         
         # Генерируем промпт через Gemini с использованием выбранной модели
-        prompt = await generate_prompt(transcription, user_id)
+        prompt = await stream_prompt(
+            message, user_id,
+            lambda on_partial: generate_prompt(transcription, user_id, on_partial=on_partial),
+            header=f"🎤 Распознанный текст:\n\n{transcription[:500]}\n\n✍️ Генерирую промпт..."
+        )
         if not prompt:
-            await message.edit_text("Произошла ошибка при создании промпта. Пожалуйста, попробуйте позже.")
             return ConversationHandler.END
         
         # Сохраняем промпт в контексте
@@ -930,44 +1271,28 @@ async def handle_photo_message(update: Update, context: ContextTypes.DEFAULT_TYP
             await message.edit_text("⚠️ Не удалось обработать изображение. Пожалуйста, отправьте другое фото.")
             return ConversationHandler.END
         
-        # Получаем размер фото для логирования
-        photo_size = update.message.photo[-1].file_size
-        logger.info(f"Получено изображение размером {photo_size} байт")
-        
-        # Получаем файл изображения (берем с наилучшим качеством)
-        photo_file = await update.message.photo[-1].get_file()
-        
-        # Создаем временный файл для сохранения изображения
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_photo:
-            photo_path = temp_photo.name
-        
-        # Загружаем изображение
-        await photo_file.download_to_drive(photo_path)
-        logger.info(f"Изображение сохранено во временный файл: {photo_path}")
-        
-        # Проверяем, что файл существует и не пустой
-        if not os.path.exists(photo_path) or os.path.getsize(photo_path) == 0:
-            logger.error(f"Проблема с сохранением изображения: файл не создан или пустой")
-            await message.edit_text("⚠️ Произошла ошибка при сохранении изображения. Пожалуйста, попробуйте еще раз.")
-            
-            # Попытка удаления временного файла, если он существует
-            if os.path.exists(photo_path):
-                os.remove(photo_path)
-                
-            return ConversationHandler.END
-        
         # Получаем ID пользователя для использования выбранной модели
         user_id = update.effective_user.id
-        
-        # Анализируем содержимое изображения с использованием выбранной модели
-        image_description = await analyze_image_content(photo_path, user_id)
-        
-        # Удаляем временный файл
-        try:
-            os.remove(photo_path)
-            logger.info(f"Временный файл удален: {photo_path}")
-        except Exception as e:
-            logger.warning(f"Не удалось удалить временный файл: {e}")
+
+        # Берем фото с наилучшим качеством
+        photo = update.message.photo[-1]
+
+        # Повторно отправленное фото уже проанализировано — не скачиваем его снова
+        prompt = None
+        image_description = await get_cached_image_description(photo.file_unique_id, user_id)
+        if not image_description:
+            # Получаем размер фото для логирования
+            logger.info(f"Получено изображение размером {photo.file_size} байт")
+
+            # Загружаем изображение и анализируем его; описание сохраняется в кэш
+            async with telegram_media(photo, ".jpg") as image:
+                if PHOTO_PROMPT_MODE == "single":
+                    # Описание и промпт одним мультимодальным запросом
+                    result = await analyze_photo(image, user_id, photo.file_unique_id)
+                    if result:
+                        image_description, prompt = result
+                if not image_description:
+                    image_description = await analyze_image_content(image, user_id, photo.file_unique_id)
         
         if not image_description:
             await message.edit_text("⚠️ Не удалось проанализировать изображение. Пожалуйста, попробуйте другое изображение или отправьте текстовый запрос.")
@@ -977,14 +1302,17 @@ async def handle_photo_message(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data["user_request"] = image_description
         context.user_data["request_type"] = "image"
         
-        # Информируем пользователя о том, что изображение проанализировано
-        await message.edit_text("🖼 Изображение проанализировано. Генерирую промпт...")
-        
-        # Генерируем промпт на основе описания изображения с использованием выбранной модели
-        prompt = await analyze_image(image_description, user_id)
         if not prompt:
-            await message.edit_text("Произошла ошибка при создании промпта. Пожалуйста, попробуйте позже.")
-            return ConversationHandler.END
+            # Информируем пользователя о том, что изображение проанализировано
+            await message.edit_text("🖼 Изображение проанализировано. Генерирую промпт...")
+            
+            # Генерируем промпт на основе описания изображения с использованием выбранной модели
+            prompt = await stream_prompt(
+                message, user_id,
+                lambda on_partial: analyze_image(image_description, user_id, on_partial=on_partial)
+            )
+            if not prompt:
+                return ConversationHandler.END
         
         # Сохраняем промпт в контексте
         context.user_data["prompt"] = prompt
@@ -1013,54 +1341,13 @@ async def show_prompt_confirmation(update: Update, context, message, prompt):
         request_type = context.user_data.get("request_type", "text")
         cycles = settings.get("generation_cycles", 1)
         
-        # Генерируем изображения в нескольких циклах
-        for cycle in range(1, cycles + 1):
-            if cycles > 1:
-                await message.edit_text(f"🎨 Цикл {cycle}/{cycles}: генерирую промпт...")
-                
-                # В каждом цикле (кроме первого) генерируем новый промпт
-                if cycle > 1:
-                    if request_type == "image":
-                        prompt = await analyze_image(user_request, user_id)
-                    else:
-                        prompt = await generate_prompt(user_request, user_id)
-                        
-                    if not prompt:
-                        await message.edit_text(f"⚠️ Ошибка при генерации промпта в цикле {cycle}. Пропускаю...")
-                        continue
-            
-            # Обновляем статус
-            if cycles > 1:
-                await message.edit_text(f"🎨 Цикл {cycle}/{cycles}: генерирую изображение (это может занять до 3 минут)...")
-            else:
-                await message.edit_text("🎨 Генерирую изображение (это может занять до 3 минут)...")
-            
-            # Генерируем изображение
-            image_urls = await generate_image(prompt, user_id)
-            if not image_urls:
-                if cycles > 1:
-                    await message.edit_text(f"⚠️ Ошибка при генерации изображения в цикле {cycle}. Пропускаю...")
-                    continue
-                else:
-                    await message.edit_text("Произошла ошибка при генерации изображения. Пожалуйста, попробуйте позже.")
-                    return ConversationHandler.END
-            
-            # Отправляем все сгенерированные изображения
-            for url in image_urls:
-                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=url)
-
-            # Отправляем использованный промпт для справки (обрезаем если слишком длинный)
-            cycle_text = f" (цикл {cycle}/{cycles})" if cycles > 1 else ""
-            max_prompt_length = 1000
-            prompt_display = prompt if len(prompt) <= max_prompt_length else prompt[:max_prompt_length] + "..."
-
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=f"Использованный промпт{cycle_text}:\n`{prompt_display}`",
-                parse_mode="Markdown",
-                read_timeout=30,
-                write_timeout=30
-            )
+        # Генерируем изображения (циклы выполняются параллельно)
+        succeeded = await run_generation_cycles(
+            context.bot, update.effective_chat.id, user_id, message,
+            prompt, user_request, request_type, cycles
+        )
+        if not succeeded and cycles == 1:
+            return ConversationHandler.END
         
         # Удаляем сообщение о статусе
         await message.delete()
@@ -1069,7 +1356,7 @@ async def show_prompt_confirmation(update: Update, context, message, prompt):
         if cycles > 1:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text=f"✅ Генерация завершена! Сгенерировано {cycles} вариант{'ов' if cycles > 1 else ''}."
+                text=f"✅ Генерация завершена! Сгенерировано {succeeded} из {cycles} вариантов."
             )
             
         return ConversationHandler.END
@@ -1099,6 +1386,9 @@ async def show_prompt_confirmation(update: Update, context, message, prompt):
         reply_markup=reply_markup,
         parse_mode="Markdown"
     )
+
+    # Пока пользователь решает, готовим альтернативный промпт
+    start_prompt_prefetch(user_id, context.user_data.get("user_request"), context.user_data.get("request_type", "text"))
     
     return AWAITING_CONFIRMATION
 
@@ -1127,8 +1417,12 @@ async def prompt_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
             
             # Проверяем, что запрос и промпт существуют
             if not user_request or not prompt:
+                cancel_prompt_prefetch(user_id)
                 await query.message.edit_text("Произошла ошибка: запрос или промпт не найдены. Пожалуйста, попробуйте снова.")
                 return ConversationHandler.END
+
+            # Заранее сгенерированный промпт пойдёт во второй цикл
+            prefetched = take_prompt_prefetch(user_id, user_request)
             
             # Удаляем сообщение о подтверждении
             await query.message.delete()
@@ -1139,53 +1433,13 @@ async def prompt_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
                 text=f"🎨 Начинаю генерацию изображений ({cycles} цикл{'ов' if cycles > 1 else ''})..."
             )
             
-            # Генерируем изображения в нескольких циклах
-            for cycle in range(1, cycles + 1):
-                # В каждом цикле (кроме первого) генерируем новый промпт
-                if cycles > 1 and cycle > 1:
-                    await status_message.edit_text(f"🎨 Цикл {cycle}/{cycles}: генерирую промпт...")
-
-                    if request_type == "image":
-                        prompt = await analyze_image(user_request, user_id)
-                    else:
-                        prompt = await generate_prompt(user_request, user_id)
-
-                    if not prompt:
-                        await status_message.edit_text(f"⚠️ Ошибка при генерации промпта в цикле {cycle}. Пропускаю...")
-                        continue
-
-                # Обновляем статус
-                if cycles > 1:
-                    await status_message.edit_text(f"🎨 Цикл {cycle}/{cycles}: генерирую изображение (это может занять до 3 минут)...")
-                else:
-                    await status_message.edit_text("🎨 Генерирую изображение (это может занять до 3 минут)...")
-
-                # Генерируем изображение
-                image_urls = await generate_image(prompt, user_id)
-                if not image_urls:
-                    if cycles > 1:
-                        await status_message.edit_text(f"⚠️ Ошибка при генерации изображения в цикле {cycle}. Пропускаю...")
-                        continue
-                    else:
-                        await status_message.edit_text("Произошла ошибка при генерации изображения. Пожалуйста, попробуйте позже.")
-                        return ConversationHandler.END
-
-                # Отправляем все сгенерированные изображения
-                for url in image_urls:
-                    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=url)
-
-                # Отправляем использованный промпт для справки (обрезаем если слишком длинный)
-                cycle_text = f" (цикл {cycle}/{cycles})" if cycles > 1 else ""
-                max_prompt_length = 1000
-                prompt_display = prompt if len(prompt) <= max_prompt_length else prompt[:max_prompt_length] + "..."
-
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"Использованный промпт{cycle_text}:\n`{prompt_display}`",
-                    parse_mode="Markdown",
-                    read_timeout=30,
-                    write_timeout=30
-                )
+            # Генерируем изображения (циклы выполняются параллельно)
+            succeeded = await run_generation_cycles(
+                context.bot, update.effective_chat.id, user_id, status_message,
+                prompt, user_request, request_type, cycles, prefetched
+            )
+            if not succeeded and cycles == 1:
+                return ConversationHandler.END
 
             # Удаляем сообщение о статусе
             await status_message.delete()
@@ -1194,7 +1448,7 @@ async def prompt_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
             if cycles > 1:
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id,
-                    text=f"✅ Генерация завершена! Сгенерировано {cycles} вариант{'ов' if cycles > 1 else ''}."
+                    text=f"✅ Генерация завершена! Сгенерировано {succeeded} из {cycles} вариантов."
                 )
 
             # ВАЖНО: Завершаем разговор после генерации изображений
@@ -1212,15 +1466,16 @@ async def prompt_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
             # Получаем ID пользователя для использования выбранной модели
             user_id = update.effective_user.id
             
-            # Генерируем новый промпт в зависимости от типа запроса
+            # Берем заранее сгенерированный промпт, а если его нет — генерируем новый
             request_type = context.user_data.get("request_type", "text")
-            if request_type == "image":
-                prompt = await analyze_image(user_request, user_id)
-            else:
-                prompt = await generate_prompt(user_request, user_id)
-                
+            prefetched = take_prompt_prefetch(user_id, user_request)
+            prompt = await _await_prefetch(prefetched) if prefetched is not None else None
+            if not prompt:
+                prompt = await stream_prompt(
+                    query.message, user_id,
+                    lambda on_partial: _regenerate_prompt(user_request, request_type, user_id, on_partial)
+                )
             if not prompt:
-                await query.message.edit_text("Произошла ошибка при создании промпта. Пожалуйста, попробуйте позже.")
                 return ConversationHandler.END
             
             # Обновляем промпт в контексте
@@ -1250,11 +1505,15 @@ async def prompt_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
                 reply_markup=reply_markup,
                 parse_mode="Markdown"
             )
+
+            # Готовим следующий вариант на случай ещё одного повтора
+            start_prompt_prefetch(user_id, user_request, request_type)
             
             return AWAITING_CONFIRMATION
             
         elif query.data == "prompt_cancel":
             # Пользователь отменил операцию
+            cancel_prompt_prefetch(query.from_user.id)
             await query.message.edit_text("❌ Операция отменена. Отправьте новый запрос для генерации изображения.")
             return ConversationHandler.END
 
@@ -1288,6 +1547,7 @@ async def benchmark_prompt_handler(update: Update, context: ContextTypes.DEFAULT
     keyboard = [
         [InlineKeyboardButton(f"Выполнить все комбинации ({total_combinations})", callback_data="run_all_combinations")],
         [InlineKeyboardButton("Указать количество случайных комбинаций", callback_data="set_combinations_count")],
+        [InlineKeyboardButton("🧭 Адаптивный поиск лучших параметров", callback_data="run_adaptive_search")],
         [InlineKeyboardButton("◀️ Назад к настройкам", callback_data="back_to_settings")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1335,6 +1595,7 @@ async def benchmark_options_handler(update: Update, context: ContextTypes.DEFAUL
             keyboard = [
                 [InlineKeyboardButton(f"Выполнить все комбинации ({total_combinations})", callback_data="run_all_combinations")],
                 [InlineKeyboardButton("Указать количество случайных комбинаций", callback_data="set_combinations_count")],
+                [InlineKeyboardButton("🧭 Адаптивный поиск лучших параметров", callback_data="run_adaptive_search")],
                 [InlineKeyboardButton("◀️ Назад к настройкам", callback_data="back_to_settings")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1368,6 +1629,14 @@ async def benchmark_options_handler(update: Update, context: ContextTypes.DEFAUL
             f"Пожалуйста, введите желаемое количество случайных комбинаций параметров (от 1 до {min(total_combinations, MAX_BENCHMARK_ITERATIONS)}):"
         )
         return AWAITING_BENCHMARK_COUNT
+
+    elif query.data == "run_adaptive_search":
+        await query.message.edit_text(
+            "✅ Выбран адаптивный поиск: конфигурации сначала генерируются на малом числе шагов, "
+            "дальше проходят только лучшие по оценке резкости.\n"
+            "Начинаю генерацию..."
+        )
+        return await run_adaptive_benchmark(update, context, prompt)
     
     return AWAITING_BENCHMARK_OPTIONS
 
@@ -1432,6 +1701,13 @@ async def benchmark_count_handler(update: Update, context: ContextTypes.DEFAULT_
 
 async def run_benchmark(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str, iterations: int):
     """Запускает прогон параметров с заданным количеством итераций."""
+    if is_sweep_running(update.effective_user.id):
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="⚠️ У вас уже идёт прогон параметров. Дождитесь его завершения или остановите командой /cancel."
+        )
+        return ConversationHandler.END
+    
     # Определяем, откуда пришел запрос - из сообщения или из коллбэка
     if update.callback_query:
         chat_id = update.callback_query.message.chat_id
@@ -1451,93 +1727,52 @@ async def run_benchmark(update: Update, context: ContextTypes.DEFAULT_TYPE, prom
             parse_mode="Markdown"
         )
     
-    # Получаем базовые параметры для прогона
-    base_params = BENCHMARK_SETTINGS.copy()
-    
     # Создаем список всех возможных комбинаций параметров для прогона
-    all_parameter_combinations = []
-    for prompt_strength in BENCHMARK_PROMPT_STRENGTHS:
-        for guidance_scale in BENCHMARK_GUIDANCE_SCALES:
-            for inference_steps in BENCHMARK_INFERENCE_STEPS:
-                all_parameter_combinations.append({
-                    "prompt_strength": prompt_strength,
-                    "guidance_scale": guidance_scale,
-                    "num_inference_steps": inference_steps
-                })
+    all_parameter_combinations = build_combinations()
     
     # Выбираем нужное количество комбинаций
     parameter_combinations = all_parameter_combinations
     if iterations < len(all_parameter_combinations):
         # Если нужно меньше комбинаций, чем всего возможно, выбираем случайные
-        import random
         parameter_combinations = random.sample(all_parameter_combinations, iterations)
     
-    # Запускаем прогон параметров
-    try:
-        total_iterations = len(parameter_combinations)
-        for i, params in enumerate(parameter_combinations, 1):
-            # Обновляем статусное сообщение
-            await status_message.edit_text(
-                f"🔬 *Прогон параметров: {i}/{total_iterations}*\n\n"
-                f"• Сила промпта: {params['prompt_strength']}\n"
-                f"• Guidance Scale: {params['guidance_scale']}\n"
-                f"• Шаги инференса: {params['num_inference_steps']}\n\n"
-                "⏳ Генерация изображения...",
-                parse_mode="Markdown"
-            )
-            
-            # Собираем все параметры
-            generation_params = base_params.copy()
-            generation_params.update(params)
-            
-            # Запускаем генерацию изображения с текущими параметрами
-            image_urls = await generate_image_with_params(prompt, generation_params)
-            
-            if not image_urls:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⚠️ Ошибка генерации для комбинации #{i}:\n"
-                         f"• Сила промпта: {params['prompt_strength']}\n"
-                         f"• Guidance Scale: {params['guidance_scale']}\n"
-                         f"• Шаги инференса: {params['num_inference_steps']}"
-                )
-                continue
-            
-            # Отправляем изображение с описанием параметров
-            caption = (
-                f"🔍 *Результат прогона #{i}/{total_iterations}*\n\n"
-                f"• Сила промпта: {params['prompt_strength']}\n"
-                f"• Guidance Scale: {params['guidance_scale']}\n"
-                f"• Шаги инференса: {params['num_inference_steps']}"
-            )
-            
-            # Отправляем сгенерированное изображение
-            for url in image_urls:
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=url,
-                    caption=caption,
-                    parse_mode="Markdown"
-                )
-        
-        # Завершаем прогон
-        await status_message.edit_text(
-            f"✅ *Прогон параметров завершен!*\n\n"
-            f"Было сгенерировано {total_iterations} вариантов с разными параметрами.\n"
-            f"Выберите наиболее подходящую комбинацию параметров для своих задач.",
-            parse_mode="Markdown"
-        )
-        
-    except Exception as e:
-        logger.error(f"Ошибка при выполнении прогона параметров: {e}")
-        await status_message.edit_text(
-            f"❌ *Произошла ошибка при выполнении прогона:*\n{str(e)[:100]}\n\n"
-            f"Было выполнено {i-1} из {total_iterations} итераций.",
-            parse_mode="Markdown"
-        )
+    # Запускаем прогон параметров в фоне: комбинации генерируются параллельно,
+    # а диалог завершается сразу, чтобы /cancel мог остановить прогон
+    sweep = BenchmarkSweep(
+        context.bot, chat_id, update.effective_user.id, prompt,
+        parameter_combinations, status_message.message_id
+    )
+    # Сохраняем задание, чтобы прогон пережил перезапуск бота
+    await asyncio.to_thread(sweep.save)
+    start_sweep(sweep)
     
     return ConversationHandler.END
 
+async def run_adaptive_benchmark(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str):
+    """Запускает адаптивный поиск параметров (successive halving)."""
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    if is_sweep_running(user_id):
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="⚠️ У вас уже идёт прогон параметров. Дождитесь его завершения или остановите командой /cancel."
+        )
+        return ConversationHandler.END
+
+    status_message = await context.bot.send_message(
+        chat_id=chat_id,
+        text="🧭 *Начинаю адаптивный поиск параметров*\n\n"
+            f"Промпт: `{prompt[:100]}{'...' if len(prompt) > 100 else ''}`\n\n"
+            "⏳ Генерация началась...",
+        parse_mode="Markdown"
+    )
+
+    search = AdaptiveSearch(context.bot, chat_id, user_id, prompt, status_message.message_id)
+    await asyncio.to_thread(search.save)
+    start_sweep(search)
+
+    return ConversationHandler.END
+
 
 # =================================================================
 # Фотосессии
@@ -1566,6 +1801,8 @@ async def photoshoot_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         result = await run_photoshoot(
             num_photos=10,
             progress_callback=progress_callback,
+            user_id=user_id,
+            chat_id=chat_id,
         )
 
         # Удаляем статусное сообщение
@@ -1592,15 +1829,20 @@ async def photoshoot_schedule_handler(update: Update, context: ContextTypes.DEFA
     data = query.data
 
     schedule = get_schedule(user_id)
+    # Чат доставки нужен, чтобы восстановить задачи после перезапуска бота
+    schedule["chat_id"] = chat_id
 
     if data == "ps_toggle":
         schedule["enabled"] = not schedule.get("enabled", False)
+        if schedule["enabled"]:
+            # Нижняя граница для догоняющего запуска, пока расписание ещё не срабатывало
+            schedule["enabled_at"] = time.time()
         update_schedule(user_id, schedule)
 
-        if schedule["enabled"]:
-            setup_scheduled_jobs(context.application, user_id, chat_id)
-        else:
-            remove_scheduled_jobs(context.application, user_id)
+        # Сдвиги старта зависят от расписаний всех пользователей — пересобираем план
+        if not schedule["enabled"]:
+            remove_scheduled_jobs(context.application, user_id, include_catchup=True)
+        reschedule_photoshoots(context.application)
 
     elif data.startswith("ps_day_"):
         day = int(data.replace("ps_day_", ""))
@@ -1614,7 +1856,7 @@ async def photoshoot_schedule_handler(update: Update, context: ContextTypes.DEFA
         update_schedule(user_id, schedule)
 
         if schedule.get("enabled"):
-            setup_scheduled_jobs(context.application, user_id, chat_id)
+            reschedule_photoshoots(context.application)
 
     elif data.startswith("ps_hour_"):
         hour = int(data.replace("ps_hour_", ""))
@@ -1622,7 +1864,7 @@ async def photoshoot_schedule_handler(update: Update, context: ContextTypes.DEFA
         update_schedule(user_id, schedule)
 
         if schedule.get("enabled"):
-            setup_scheduled_jobs(context.application, user_id, chat_id)
+            reschedule_photoshoots(context.application)
 
     elif data == "ps_back":
         # Возвращаемся в меню настроек через edit существующего сообщения
@@ -1704,6 +1946,8 @@ async def _show_schedule_menu(query, schedule: dict):
     await query.message.edit_text(
         f"Расписание фотосессий: {status_emoji}\n"
         f"Текущее: {current_text}\n\n"
+        f"Фотосессии, назначенные на одно время, запускаются по очереди, "
+        f"поэтому фото приходят в пределах {SCHEDULE_SPREAD // 60} мин до или после выбранного времени.\n\n"
         f"Настройте расписание автоматических фотосессий:",
         reply_markup=InlineKeyboardMarkup(keyboard),
     )
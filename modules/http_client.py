@@ -0,0 +1,177 @@
+"""
+Модуль асинхронного HTTP-клиента для скачивания файлов.
+
+Один aiohttp.ClientSession на процесс, который создаётся в post_init
+приложения и закрывается в post_shutdown: keep-alive и TLS-соединения
+переиспользуются между запросами (в том числе к CDN fal.ai), DNS-ответы
+кэшируются, число соединений ограничено и в целом, и на один хост.
+Файлы скачиваются потоком в память или на диск с ограничением размера,
+а временные ошибки сети повторяются с экспоненциальной задержкой.
+"""
+
+import asyncio
+import os
+import tempfile
+from typing import Optional
+
+import aiohttp
+
+from modules.config import (
+    TIMEOUT, DOWNLOAD_CONCURRENCY, DOWNLOAD_RETRIES, HTTP_LIMIT_PER_HOST,
+    HTTP_DNS_CACHE_TTL, HTTP_MAX_DOWNLOAD_SIZE, logger
+)
+
+_session: Optional[aiohttp.ClientSession] = None
+_download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadTooLargeError(Exception):
+    """Файл превышает допустимый размер скачивания."""
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=DOWNLOAD_CONCURRENCY * 2,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=60,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+    )
+
+
+async def init_session() -> aiohttp.ClientSession:
+    """Создаёт общий ClientSession (вызывается из post_init приложения)."""
+    session = get_session()
+    logger.info(
+        f"HTTP-клиент инициализирован: до {DOWNLOAD_CONCURRENCY * 2} соединений, "
+        f"{HTTP_LIMIT_PER_HOST} на хост, DNS-кэш {HTTP_DNS_CACHE_TTL} с"
+    )
+    return session
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Возвращает общий ClientSession, создавая его при первом обращении."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+async def close_session() -> None:
+    """Закрывает общий ClientSession (вызывается из post_shutdown приложения)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _stream(url: str, sink, max_size: int, retries: int, reset=None) -> int:
+    """
+    Скачивает файл потоком, передавая части в sink.
+
+    Args:
+        url: URL файла
+        sink: Функция, принимающая очередную часть файла
+        max_size: Максимальный размер файла в байтах
+        retries: Количество попыток
+        reset: Функция, сбрасывающая уже записанные данные перед повтором
+
+    Returns:
+        Размер файла в байтах
+
+    Raises:
+        DownloadTooLargeError: Если файл больше max_size
+        aiohttp.ClientError, asyncio.TimeoutError: Если все попытки неудачны
+    """
+    delay = 1.0
+    for attempt in range(1, retries + 1):
+        try:
+            async with _download_semaphore:
+                async with get_session().get(url) as response:
+                    response.raise_for_status()
+                    if response.content_length and response.content_length > max_size:
+                        raise DownloadTooLargeError(
+                            f"{url}: {response.content_length} байт при лимите {max_size}"
+                        )
+                    size = 0
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > max_size:
+                            raise DownloadTooLargeError(f"{url}: больше {max_size} байт")
+                        sink(chunk)
+                    return size
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                raise
+            logger.warning(f"Ошибка скачивания {url} (попытка {attempt}/{retries}): {e}. Повтор через {delay:.0f} с")
+            if reset:
+                reset()
+            await asyncio.sleep(delay)
+            delay *= 2
+
+
+async def fetch_bytes(url: str, retries: int = DOWNLOAD_RETRIES,
+                      max_size: int = HTTP_MAX_DOWNLOAD_SIZE) -> bytes:
+    """
+    Скачивает файл по URL в память с повторами при ошибках.
+
+    Args:
+        url: URL файла
+        retries: Количество попыток
+        max_size: Максимальный размер файла в байтах
+
+    Returns:
+        Содержимое файла
+
+    Raises:
+        DownloadTooLargeError: Если файл больше max_size
+        aiohttp.ClientError, asyncio.TimeoutError: Если все попытки неудачны
+    """
+    data = bytearray()
+    await _stream(url, data.extend, max_size, retries, reset=data.clear)
+    return bytes(data)
+
+
+async def fetch_to_file(url: str, path: Optional[str] = None, retries: int = DOWNLOAD_RETRIES,
+                        max_size: int = HTTP_MAX_DOWNLOAD_SIZE) -> str:
+    """
+    Скачивает файл по URL на диск потоком, не держа его целиком в памяти.
+
+    Args:
+        url: URL файла
+        path: Путь для сохранения (по умолчанию — новый временный файл)
+        retries: Количество попыток
+        max_size: Максимальный размер файла в байтах
+
+    Returns:
+        Путь к скачанному файлу
+
+    Raises:
+        DownloadTooLargeError: Если файл больше max_size
+        aiohttp.ClientError, asyncio.TimeoutError: Если все попытки неудачны
+    """
+    if path is None:
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+    try:
+        with open(path, "wb") as f:
+            def reset():
+                f.seek(0)
+                f.truncate()
+
+            await _stream(url, f.write, max_size, retries, reset=reset)
+        return path
+    except BaseException:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+
@@ -5,21 +5,23 @@
 """
 
 import asyncio
-import io
 import random
+import tempfile
+import threading
 import zipfile
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 
-import requests
-import fal_client
-from google import genai
 from google.genai import types
 
 from modules.config import (
-    GEMINI_API_KEY, FAL_MODEL_ID, FAL_LORA_URL, FAL_LORA_SCALE,
-    TRIGGER_WORD, SUBJECT_DESCRIPTION, TIMEOUT, logger
+    GEMINI_API_KEY, FAL_LORA_URL, FAL_LORA_SCALE,
+    TRIGGER_WORD, SUBJECT_DESCRIPTION, PHOTOSHOOT_WINDOW, ZIP_SPOOL_MAX_SIZE, logger
 )
+from modules.ai_services import gemini_generate_content
+from modules.fal_dispatcher import run_fal, PRIORITY_INTERACTIVE
+from modules.generation_jobs import JobTracker, KIND_PHOTOSHOOT
+from modules.http_client import fetch_bytes
 
 # ─────────────────────────────────────────────
 # Библиотеки
@@ -387,12 +389,9 @@ def generate_photoshoot_config(num_photos: int = 10) -> PhotoshootConfig:
 # Генерация промптов через Gemini
 # ─────────────────────────────────────────────
 
-gemini_client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
-
-
 async def generate_photoshoot_prompts(config: PhotoshootConfig) -> List[str]:
     """Генерирует 10 детальных промптов через Gemini за 1 запрос."""
-    if not gemini_client:
+    if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY не задан — невозможно генерировать промпты")
 
     poses_str = "\n".join(
@@ -423,17 +422,13 @@ async def generate_photoshoot_prompts(config: PhotoshootConfig) -> List[str]:
 
     logger.info(f"Генерация {config.num_photos} промптов через Gemini")
 
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(
-        None,
-        lambda: gemini_client.models.generate_content(
-            model="gemini-2.5-flash",
-            config=types.GenerateContentConfig(
-                temperature=0.8,
-                max_output_tokens=16384,
-            ),
-            contents=meta_prompt,
+    response = await gemini_generate_content(
+        model="gemini-2.5-flash",
+        config=types.GenerateContentConfig(
+            temperature=0.8,
+            max_output_tokens=16384,
         ),
+        contents=meta_prompt,
     )
 
     raw = response.text.strip()
@@ -454,46 +449,71 @@ async def generate_photoshoot_images(
     prompts: List[str],
     orientations: List[str],
     progress_callback=None,
+    priority: int = PRIORITY_INTERACTIVE,
+    user_id: Optional[int] = None,
+    on_image_ready=None,
+    job_tracker: Optional[JobTracker] = None,
 ) -> List[dict]:
     """
-    Генерирует все изображения фотосессии с rate limiting.
-    Батчами по 2 (concurrent limit fal.ai для нового аккаунта).
-    """
-    all_results = []
-    batch_size = 2
-    total = len(prompts)
-
-    for i in range(0, total, batch_size):
-        batch_prompts = prompts[i:i + batch_size]
-        batch_orientations = orientations[i:i + batch_size]
-
-        if progress_callback:
-            await progress_callback(i, total)
+    Генерирует все изображения фотосессии скользящим окном.
 
-        # Запускаем batch_size запросов параллельно
-        tasks = []
-        for p, o in zip(batch_prompts, batch_orientations):
-            tasks.append(_generate_single(p, o))
+    В работе одновременно не больше PHOTOSHOOT_WINDOW генераций: как только
+    любая из них завершается, сразу стартует следующий промпт, без барьеров
+    между батчами. Слоты fal.ai дополнительно ограничивает глобальный диспетчер.
 
-        batch_results = await asyncio.gather(*tasks, return_exceptions=True)
+    Args:
+        prompts: Промпты изображений
+        orientations: Ориентации (image_size fal.ai) для каждого промпта
+        progress_callback: async (completed, total) — вызывается после каждого изображения
+        priority: Приоритет запросов в диспетчере fal.ai
+        user_id: ID пользователя Telegram
+        on_image_ready: async (index, result) — вызывается для каждого успешного изображения
+        job_tracker: JobTracker, сохраняющий запросы fal.ai для восстановления после перезапуска
 
-        for r in batch_results:
-            if isinstance(r, dict):
-                all_results.append(r)
-            elif isinstance(r, Exception):
-                logger.error(f"Ошибка генерации в batch: {r}")
-
-        # Пауза между батчами чтобы не упереться в лимит
-        if i + batch_size < total:
-            await asyncio.sleep(2)
+    Returns:
+        Успешные результаты в порядке промптов
+    """
+    total = len(prompts)
+    results: List[Optional[dict]] = [None] * total
+    window = asyncio.Semaphore(PHOTOSHOOT_WINDOW)
+    completed = 0
+
+    async def worker(index: int, prompt: str, orientation: str) -> None:
+        nonlocal completed
+        async with window:
+            try:
+                on_submitted = job_tracker.callback(index, index=index) if job_tracker else None
+                result = await _generate_single(prompt, orientation, priority, user_id, on_submitted)
+                result["index"] = index
+            except Exception as e:
+                logger.error(f"Ошибка генерации изображения {index + 1}/{total}: {e}")
+                result = None
+
+        results[index] = result
+        completed += 1
+
+        if result and on_image_ready:
+            await on_image_ready(index, result)
+        if progress_callback:
+            await progress_callback(completed, total)
 
     if progress_callback:
-        await progress_callback(total, total)
+        await progress_callback(0, total)
+
+    await asyncio.gather(*(
+        worker(i, p, o) for i, (p, o) in enumerate(zip(prompts, orientations))
+    ))
 
-    return all_results
+    return [r for r in results if r is not None]
 
 
-async def _generate_single(prompt: str, orientation: str) -> dict:
+async def _generate_single(
+    prompt: str,
+    orientation: str,
+    priority: int = PRIORITY_INTERACTIVE,
+    user_id: Optional[int] = None,
+    on_submitted=None,
+) -> dict:
     """Генерирует одно изображение."""
     loras = []
     if FAL_LORA_URL:
@@ -510,15 +530,9 @@ async def _generate_single(prompt: str, orientation: str) -> dict:
         "loras": loras,
     }
 
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(
-        None,
-        lambda: fal_client.subscribe(
-            FAL_MODEL_ID,
-            arguments=arguments,
-            with_logs=True,
-            on_queue_update=lambda u: None,
-        ),
+    result = await run_fal(
+        arguments, priority=priority, user_id=user_id,
+        on_submitted=on_submitted, durable=on_submitted is not None,
     )
 
     images = result.get("images", [])
@@ -531,34 +545,78 @@ async def _generate_single(prompt: str, orientation: str) -> dict:
 # Скачивание и сборка ZIP
 # ─────────────────────────────────────────────
 
-async def download_images(image_results: List[dict]) -> List[bytes]:
-    """Скачивает все изображения по URL, возвращает байты."""
-    loop = asyncio.get_running_loop()
-    downloaded = []
+async def _download_image(index: int, url: str) -> Optional[bytes]:
+    """Скачивает одно изображение фотосессии, возвращает None при ошибке."""
+    try:
+        data = await fetch_bytes(url)
+        logger.info(f"Скачано изображение {index + 1} ({len(data)} байт)")
+        return data
+    except Exception as e:
+        logger.error(f"Ошибка скачивания {url}: {e}")
+        return None
 
-    for i, img in enumerate(image_results):
-        url = img["url"]
-        try:
-            data = await loop.run_in_executor(
-                None,
-                lambda u=url: requests.get(u, timeout=TIMEOUT).content,
-            )
-            downloaded.append(data)
-            logger.info(f"Скачано изображение {i+1}/{len(image_results)}")
-        except Exception as e:
-            logger.error(f"Ошибка скачивания {url}: {e}")
 
-    return downloaded
+def _zip_entry(session_name: str, number: int, data: bytes):
+    """
+    Возвращает имя файла и метод сжатия для изображения в архиве.
 
+    JPEG и PNG уже сжаты, поэтому кладутся без сжатия (ZIP_STORED):
+    deflate не уменьшает их размер, но тратит CPU.
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return f"{session_name}/{session_name}_{number:02d}.png", zipfile.ZIP_STORED
+    if data[:3] == b"\xff\xd8\xff":
+        return f"{session_name}/{session_name}_{number:02d}.jpg", zipfile.ZIP_STORED
+    return f"{session_name}/{session_name}_{number:02d}.jpg", zipfile.ZIP_DEFLATED
 
-def build_zip(image_bytes_list: List[bytes], session_name: str) -> bytes:
-    """Собирает ZIP-архив из списка изображений."""
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        for i, data in enumerate(image_bytes_list, 1):
-            zf.writestr(f"{session_name}/{session_name}_{i:02d}.jpg", data)
-    buf.seek(0)
-    return buf.read()
+
+class PhotoshootArchive:
+    """
+    ZIP-архив фотосессии, пополняемый по мере скачивания изображений.
+
+    Архив пишется в SpooledTemporaryFile (в памяти до ZIP_SPOOL_MAX_SIZE,
+    дальше на диске), запись каждого файла выполняется в executor,
+    чтобы подсчёт CRC не блокировал event loop. Запись в потоке и закрытие
+    архива разделены блокировкой потоков: отмена ожидающей корутины не
+    останавливает уже начатый writestr, и close() дожидается его окончания.
+    """
+
+    def __init__(self, session_name: str):
+        self.session_name = session_name
+        self.count = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
+        self._zip = zipfile.ZipFile(self._file, "w")
+        self._lock = asyncio.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+    async def add(self, number: int, data: bytes) -> None:
+        """Добавляет изображение с порядковым номером (с 1) в архив."""
+        name, compress_type = _zip_entry(self.session_name, number, data)
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            await loop.run_in_executor(None, self._write, name, data, compress_type)
+            self.count += 1
+
+    def _write(self, name: str, data: bytes, compress_type: int) -> None:
+        with self._write_lock:
+            if not self._closed:
+                self._zip.writestr(name, data, compress_type=compress_type)
+
+    async def finalize(self):
+        """Завершает архив и возвращает файловый объект в начальной позиции."""
+        async with self._lock:
+            with self._write_lock:
+                self._zip.close()
+                self._file.seek(0)
+        return self._file
+
+    def close(self) -> None:
+        """Освобождает временный файл архива, дождавшись начатой записи."""
+        with self._write_lock:
+            self._closed = True
+            self._zip.close()
+            self._file.close()
 
 
 # ─────────────────────────────────────────────
@@ -568,21 +626,30 @@ def build_zip(image_bytes_list: List[bytes], session_name: str) -> bytes:
 async def run_photoshoot(
     num_photos: int = 10,
     progress_callback=None,
+    priority: int = PRIORITY_INTERACTIVE,
+    user_id: Optional[int] = None,
+    chat_id: Optional[int] = None,
 ) -> dict:
     """
     Полный pipeline фотосессии:
     1. Генерация конфигурации
     2. Gemini → 10 промптов
-    3. fal.ai → 10 изображений (батчами по 2)
-    4. Скачивание + ZIP
+    3. fal.ai → 10 изображений (скользящим окном)
+    4. Скачивание (по мере готовности) + ZIP
+
+    Если передан chat_id, запросы fal.ai сохраняются в generation_jobs:
+    после перезапуска бота готовые фото будут доставлены в этот чат.
+    Получатель закрывает записи через result["job_tracker"] после отправки.
 
     Returns:
         {
             "config": PhotoshootConfig,
+            "images": [{"url": str, "data": bytes | None}, ...],
             "image_bytes": [bytes, ...],
-            "zip_bytes": bytes,
+            "zip_file": файловый объект ZIP (закрывает получатель),
             "session_name": str,
             "theme": str,
+            "job_tracker": JobTracker | None,
         }
     """
     # 1. Конфигурация
@@ -602,31 +669,72 @@ async def run_photoshoot(
     # 3. Генерация изображений
     async def img_progress(current, total):
         if progress_callback:
-            await progress_callback(current, total, f"Генерация фото {current}/{total}...")
-
-    image_results = await generate_photoshoot_images(
-        prompts, config.orientations, progress_callback=img_progress
+            await progress_callback(current, total, f"Сгенерировано фото {current}/{total}...")
+
+    # Скачивание и запись в архив стартуют сразу по готовности каждого
+    # изображения, параллельно с генерацией остальных
+    archive = PhotoshootArchive(session_name)
+    download_tasks = {}
+    job_tracker = (
+        JobTracker(KIND_PHOTOSHOOT, user_id, chat_id, theme=theme, total=len(prompts))
+        if chat_id is not None else None
     )
 
-    if not image_results:
-        raise RuntimeError("Не удалось сгенерировать ни одного изображения")
+    async def download_and_archive(index, url):
+        data = await _download_image(index, url)
+        if data is not None:
+            await archive.add(index + 1, data)
+        return data
 
-    # 4. Скачивание
-    if progress_callback:
-        await progress_callback(-1, num_photos, "Скачивание изображений...")
+    async def on_image_ready(index, result):
+        download_tasks[index] = asyncio.create_task(download_and_archive(index, result["url"]))
 
-    image_bytes = await download_images(image_results)
+    try:
+        image_results = await generate_photoshoot_images(
+            prompts, config.orientations, progress_callback=img_progress,
+            priority=priority, user_id=user_id, on_image_ready=on_image_ready,
+            job_tracker=job_tracker,
+        )
 
-    if not image_bytes:
-        raise RuntimeError("Не удалось скачать ни одного изображения")
+        if not image_results:
+            raise RuntimeError("Не удалось сгенерировать ни одного изображения")
 
-    # 5. ZIP
-    zip_bytes = build_zip(image_bytes, session_name)
+        # 4. Дожидаемся оставшихся скачиваний
+        if progress_callback:
+            await progress_callback(-1, num_photos, "Скачивание изображений...")
+
+        downloaded = await asyncio.gather(*(download_tasks[r["index"]] for r in image_results))
+
+        images = [
+            {"url": r["url"], "data": data}
+            for r, data in zip(image_results, downloaded)
+        ]
+        image_bytes = [data for data in downloaded if data is not None]
+
+        if not image_bytes:
+            raise RuntimeError("Не удалось скачать ни одного изображения")
+
+        # 5. ZIP уже собран по ходу скачивания — остаётся записать оглавление
+        zip_file = await archive.finalize()
+    except BaseException as e:
+        # Архив закрывается только после остановки всех скачиваний,
+        # чтобы ни одна запись не шла в уже закрытый ZipFile
+        for task in download_tasks.values():
+            task.cancel()
+        await asyncio.gather(*download_tasks.values(), return_exceptions=True)
+        archive.close()
+        # При отмене (остановке бота) запросы остаются в generation_jobs
+        # и будут доставлены после перезапуска
+        if isinstance(e, Exception) and job_tracker:
+            await job_tracker.finish("failed")
+        raise
 
     return {
         "config": config,
+        "images": images,
         "image_bytes": image_bytes,
-        "zip_bytes": zip_bytes,
+        "zip_file": zip_file,
         "session_name": session_name,
         "theme": theme,
+        "job_tracker": job_tracker,
     }
@@ -0,0 +1,144 @@
+"""
+Модуль кэша ответов Gemini.
+
+Ключ — SHA-256 от (модель, системный промпт, температура, входные данные),
+поэтому одинаковые запросы с одинаковыми настройками получают готовый
+ответ без обращения к Gemini. В памяти хранятся последние записи (LRU),
+записи устаревают по TTL, а при PROMPT_CACHE_DISK кэш дублируется
+в SQLite и переживает перезапуск.
+
+prompt_cache хранит сгенерированные промпты, image_analysis_cache —
+описания изображений по file_unique_id фото в Telegram.
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from modules.config import (
+    PROMPT_CACHE_SIZE, PROMPT_CACHE_TTL, PROMPT_CACHE_DISK,
+    IMAGE_ANALYSIS_CACHE_SIZE, IMAGE_ANALYSIS_CACHE_TTL, logger
+)
+from modules.storage import SQLiteDatabase
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_{table}_expires ON {table}(expires_at);
+"""
+
+# Как часто (в записях) удалять устаревшие строки из SQLite
+_PRUNE_EVERY = 200
+
+
+def make_cache_key(model: str, system_prompt: str, temperature: Optional[float], text: str) -> str:
+    """Возвращает ключ кэша для запроса к Gemini."""
+    payload = json.dumps([model, system_prompt, temperature, text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TextCache:
+    """
+    Двухуровневый кэш строк: LRU в памяти и (опционально) таблица SQLite.
+
+    Память проверяется сразу, а запросы к SQLite выполняются в пуле
+    потоков (asyncio.to_thread), чтобы не блокировать цикл событий,
+    пока другой поток держит блокировку базы.
+    """
+
+    def __init__(self, table: str, max_entries: int, ttl: float, disk: bool = PROMPT_CACHE_DISK):
+        self.table = table
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._disk_enabled = disk
+        self._db: Optional[SQLiteDatabase] = None
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._writes = 0
+
+    @property
+    def db(self) -> Optional[SQLiteDatabase]:
+        if self._disk_enabled and self._db is None:
+            try:
+                self._db = SQLiteDatabase(schema=_CACHE_SCHEMA.format(table=self.table))
+            except Exception as e:
+                logger.error(f"Кэш {self.table} на диске недоступен: {e}")
+                self._disk_enabled = False
+        return self._db
+
+    async def get(self, key: str) -> Optional[str]:
+        """Возвращает значение из кэша или None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.time():
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]
+
+        if not self._disk_enabled:
+            return None
+        try:
+            return await asyncio.to_thread(self._load, key)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша {self.table}: {e}")
+            return None
+
+    async def set(self, key: str, value: str) -> None:
+        """Сохраняет значение в кэш."""
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+
+        if not self._disk_enabled:
+            return
+        try:
+            await asyncio.to_thread(self._store, key, value, expires_at)
+        except Exception as e:
+            logger.warning(f"Ошибка записи кэша {self.table}: {e}")
+
+    def _load(self, key: str) -> Optional[str]:
+        db = self.db
+        if db is None:
+            return None
+        with db.lock:
+            row = db.conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row["value"], row["expires_at"])
+        return row["value"]
+
+    def _store(self, key: str, value: str, expires_at: float) -> None:
+        db = self.db
+        if db is None:
+            return
+        with db.lock, db.conn:
+            db.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+            self._writes += 1
+            if self._writes % _PRUNE_EVERY == 0:
+                db.conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._memory[key] = (value, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+
+# Единые кэши на процесс
+prompt_cache = TextCache("prompt_cache", PROMPT_CACHE_SIZE, PROMPT_CACHE_TTL)
+image_analysis_cache = TextCache("image_analysis_cache", IMAGE_ANALYSIS_CACHE_SIZE, IMAGE_ANALYSIS_CACHE_TTL)
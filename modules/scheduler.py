@@ -1,17 +1,37 @@
 """
 Модуль планировщика фотосессий.
 Управление расписанием через python-telegram-bot JobQueue.
+
+JobQueue живёт только в памяти процесса, поэтому при запуске бота задачи
+восстанавливаются из включённых расписаний (restore_scheduled_jobs), а
+фотосессия, пропущенная за время остановки, запускается сразу, если с
+момента её запланированного времени прошло не больше SCHEDULE_CATCHUP_GRACE.
+
+Фотосессии, запланированные разными пользователями на одно время, не
+стартуют одновременно: план (plan_schedule_offsets) оценивает, сколько
+слотов fal.ai и времени займёт каждая, и распределяет старты вокруг
+выбранного времени (не дальше SCHEDULE_SPREAD в обе стороны), чтобы в
+работе было не больше FAL_MAX_CONCURRENCY генераций.
 """
 
 import io
-from datetime import time
+import math
+import zlib
+from datetime import datetime, time, timedelta, timezone
+from itertools import groupby
+from typing import Dict, List, Optional
 
-from telegram import InputMediaPhoto
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 
-from modules.config import logger
+from modules.config import (
+    PHOTOSHOOT_DELIVERY_MODE, PHOTOSHOOT_WINDOW, PHOTOSHOOT_IMAGE_SECONDS, PHOTOSHOOT_PROMPT_SECONDS,
+    FAL_MAX_CONCURRENCY, SCHEDULE_CATCHUP_GRACE, SCHEDULE_SPREAD, logger
+)
 from modules.photoshoot import run_photoshoot
-from modules.settings import get_user_settings, update_user_settings
+from modules.delivery import send_album, rate_limiter
+from modules.fal_dispatcher import PRIORITY_SCHEDULED
+from modules.settings import get_user_settings, update_user_settings, get_enabled_schedules
 
 
 # ─────────────────────────────────────────────
@@ -24,6 +44,9 @@ DEFAULT_SCHEDULE = {
     "hour": 10,
     "minute": 0,
     "num_photos": 10,
+    # Дополнительно хранятся chat_id — чат доставки (по умолчанию совпадает
+    # с user_id), last_run — unix-время последнего запуска и enabled_at —
+    # unix-время включения расписания
 }
 
 DAY_NAMES = {
@@ -46,6 +69,37 @@ def update_schedule(user_id: int, schedule: dict) -> None:
     update_user_settings(user_id, "photoshoot_schedule", schedule)
 
 
+def _mark_schedule_run(user_id: int) -> None:
+    """Запоминает время запуска фотосессии по расписанию (для догоняющего запуска)."""
+    schedule = get_schedule(user_id)
+    schedule["last_run"] = datetime.now(timezone.utc).timestamp()
+    update_schedule(user_id, schedule)
+
+
+def last_scheduled_time(schedule: dict, now: datetime) -> Optional[datetime]:
+    """
+    Возвращает последнее запланированное время фотосессии не позже now.
+
+    Args:
+        schedule: Расписание (дни 0=Пн..6=Вс, час, минута)
+        now: Текущее время в часовом поясе JobQueue
+
+    Returns:
+        Время последнего запуска по расписанию или None, если дни не выбраны
+    """
+    days = schedule.get("days", [0, 3])
+    hour = schedule.get("hour", 10)
+    minute = schedule.get("minute", 0)
+
+    for offset in range(8):
+        candidate = (now - timedelta(days=offset)).replace(
+            hour=hour, minute=minute, second=0, microsecond=0
+        )
+        if candidate.weekday() in days and candidate <= now:
+            return candidate
+    return None
+
+
 def format_schedule(schedule: dict) -> str:
     """Форматирует расписание для отображения."""
     if not schedule.get("enabled"):
@@ -56,7 +110,82 @@ def format_schedule(schedule: dict) -> str:
     minute = schedule.get("minute", 0)
     num = schedule.get("num_photos", 10)
 
-    return f"{days} в {hour:02d}:{minute:02d}, {num} фото"
+    return f"{days} около {hour:02d}:{minute:02d}, {num} фото"
+
+
+# ─────────────────────────────────────────────
+# План запусков с учётом слотов fal.ai
+# ─────────────────────────────────────────────
+
+WEEK_SECONDS = 7 * 24 * 3600
+
+
+def _photoshoot_window() -> int:
+    """Сколько слотов fal.ai одновременно занимает одна фотосессия."""
+    return max(1, min(PHOTOSHOOT_WINDOW, FAL_MAX_CONCURRENCY))
+
+
+def estimate_photoshoot_seconds(num_photos: int) -> int:
+    """Оценивает длительность фотосессии: промпты Gemini и генерация фото окнами по слотам fal.ai."""
+    rounds = math.ceil(num_photos / _photoshoot_window())
+    return PHOTOSHOOT_PROMPT_SECONDS + rounds * PHOTOSHOOT_IMAGE_SECONDS
+
+
+def _take_lane(lanes: List[int], earliest: int, duration: int) -> int:
+    """Ставит запуск на дорожку, которая освободится раньше всех, и возвращает его старт."""
+    lane = min(range(len(lanes)), key=lanes.__getitem__)
+    planned = max(earliest, lanes[lane])
+    lanes[lane] = planned + duration
+    return planned
+
+
+def plan_schedule_offsets(schedules: Dict[int, dict], early: bool = True) -> Dict[int, Dict[int, int]]:
+    """
+    Распределяет запуски фотосессий по времени с учётом лимита слотов fal.ai.
+
+    Слоты аккаунта делятся на дорожки по PHOTOSHOOT_WINDOW слотов. Запуски
+    недели обходятся по запланированному времени, и каждый ставится на
+    дорожку, которая освободится раньше всех: если свободных нет, старт
+    сдвигается до окончания предыдущей фотосессии по оценке
+    estimate_photoshoot_seconds. Очередь запусков с одинаковым временем
+    начинается раньше него на половину своей длины, чтобы фото приходили
+    и до, и после выбранного времени, а не копились после. Сдвиг не
+    превышает SCHEDULE_SPREAD: запуски сверх этого стартуют на границе
+    и ждут слотов в диспетчере fal.ai. Порядок пользователей с одинаковым
+    временем меняется от дня к дню, чтобы последними не оказывались одни
+    и те же.
+
+    Args:
+        schedules: Включённые расписания, user_id -> photoshoot_schedule
+        early: Разрешить старт раньше запланированного времени
+
+    Returns:
+        user_id -> {день (0=Пн): сдвиг старта в секундах, может быть отрицательным}
+    """
+    runs = []
+    for user_id, schedule in schedules.items():
+        nominal = schedule.get("hour", 10) * 3600 + schedule.get("minute", 0) * 60
+        duration = estimate_photoshoot_seconds(schedule.get("num_photos", 10))
+        for day in schedule.get("days", []):
+            order = zlib.crc32(f"{user_id}:{day}".encode())
+            runs.append((day * 86400 + nominal, order, user_id, day, duration))
+    runs.sort()
+
+    lanes = [0] * max(1, FAL_MAX_CONCURRENCY // _photoshoot_window())
+    offsets: Dict[int, Dict[int, int]] = {}
+    for start, group in groupby(runs, key=lambda run: run[0]):
+        group = list(group)
+        lead = 0
+        if early:
+            # Пробный план без опережения показывает, насколько растянется очередь
+            trial = lanes.copy()
+            delay = max(_take_lane(trial, start, run[4]) - start for run in group)
+            lead = min(SCHEDULE_SPREAD, delay // 2)
+        for _, _, user_id, day, duration in group:
+            planned = min(_take_lane(lanes, start - lead, duration), start + SCHEDULE_SPREAD)
+            offsets.setdefault(user_id, {})[day] = planned - start
+
+    return offsets
 
 
 # ─────────────────────────────────────────────
@@ -66,20 +195,23 @@ def format_schedule(schedule: dict) -> str:
 async def scheduled_photoshoot_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Callback для JobQueue — генерирует и отправляет фотосессию.
-    job.data = {"chat_id": int, "user_id": int, "num_photos": int}
+    job.data = {"chat_id": int, "user_id": int, "num_photos": int, "eta": "HH:MM"}
     """
     job_data = context.job.data
     chat_id = job_data["chat_id"]
     user_id = job_data["user_id"]
     num_photos = job_data.get("num_photos", 10)
+    eta = job_data.get("eta")
 
     logger.info(f"Scheduled photoshoot для user {user_id}, chat {chat_id}")
+    _mark_schedule_run(user_id)
 
     try:
         # Уведомление о старте
         status_msg = await context.bot.send_message(
             chat_id=chat_id,
-            text="Генерация запланированной фотосессии...",
+            text=f"Генерация запланированной фотосессии (фото будут около {eta})..."
+            if eta else "Генерация запланированной фотосессии...",
         )
 
         # Callback для прогресса
@@ -93,6 +225,9 @@ async def scheduled_photoshoot_job(context: ContextTypes.DEFAULT_TYPE) -> None:
         result = await run_photoshoot(
             num_photos=num_photos,
             progress_callback=progress,
+            priority=PRIORITY_SCHEDULED,
+            user_id=user_id,
+            chat_id=chat_id,
         )
 
         # Отправка результата
@@ -117,48 +252,113 @@ async def scheduled_photoshoot_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 # ─────────────────────────────────────────────
 
 async def send_photoshoot_result(bot, chat_id: int, result: dict) -> None:
-    """Отправляет фотосессию: галерея + ZIP."""
+    """
+    Отправляет фотосессию: галерея + ZIP.
+
+    В режиме PHOTOSHOOT_DELIVERY_MODE="url" галерея отправляется ссылками fal.ai,
+    и Telegram скачивает изображения сам. Скачанные байты используются для ZIP
+    и как запасной вариант, если Telegram не принял ссылки.
+    После отправки закрывает запросы фотосессии в generation_jobs.
+    """
 
-    image_bytes_list = result["image_bytes"]
+    images = result["images"]
     theme = result["theme"]
+    zip_file = result["zip_file"]
+    job_tracker = result.get("job_tracker")
+    delivered = False
 
-    # Отправляем media group (галерея, до 10 фото)
-    media_group = []
-    for i, img_data in enumerate(image_bytes_list[:10]):
-        bio = io.BytesIO(img_data)
-        bio.name = f"photo_{i+1:02d}.jpg"
+    try:
+        # Отправляем media group (галерея, до 10 фото)
+        sent = False
+        if PHOTOSHOOT_DELIVERY_MODE == "url":
+            try:
+                await _send_gallery_by_url(bot, chat_id, images, theme)
+                sent = True
+            except BadRequest as e:
+                logger.warning(f"Telegram не принял ссылки на фото ({e}), отправляю файлами")
 
-        caption = theme if i == 0 else None
-        media_group.append(InputMediaPhoto(media=bio, caption=caption))
+        if not sent:
+            await _send_gallery_by_upload(bot, chat_id, images, theme)
+
+        # Отправляем ZIP
+        await rate_limiter.wait(chat_id)
+        await bot.send_document(
+            chat_id=chat_id,
+            document=zip_file,
+            filename=f"{result['session_name']}.zip",
+            caption=f"ZIP: {theme} ({len(result['image_bytes'])} фото, полный размер)",
+        )
+        delivered = True
+    finally:
+        zip_file.close()
+        if job_tracker:
+            await job_tracker.finish("done" if delivered else "failed")
 
-    if media_group:
-        await bot.send_media_group(chat_id=chat_id, media=media_group)
 
-    # Отправляем ZIP
-    zip_data = result["zip_bytes"]
-    zip_bio = io.BytesIO(zip_data)
-    zip_bio.name = f"{result['session_name']}.zip"
+async def deliver_recovered_photoshoot(bot, chat_id: int, entries) -> None:
+    """
+    Отправляет фото фотосессии, прерванной перезапуском бота (см. generation_jobs).
 
-    await bot.send_document(
-        chat_id=chat_id,
-        document=zip_bio,
-        caption=f"ZIP: {theme} ({len(image_bytes_list)} фото, полный размер)",
+    Фото, запросы которых не успели попасть в очередь fal.ai до остановки,
+    не генерируются повторно; ZIP не собирается — фото отправляются альбомом.
+    """
+    entries = sorted(entries, key=lambda entry: entry[0].get("index", 0))
+    payload = entries[0][0]
+    urls = [image_urls[0] for _, image_urls in entries]
+    await send_album(
+        bot, chat_id, urls,
+        caption=(
+            f"{payload.get('theme', 'Фотосессия')}\n"
+            f"♻️ Восстановлено после перезапуска бота: {len(urls)} из {payload.get('total', len(urls))} фото"
+        ),
     )
 
 
+async def _send_gallery_by_url(bot, chat_id: int, images: list, theme: str) -> None:
+    """Отправляет галерею ссылками на изображения."""
+    await send_album(bot, chat_id, [img["url"] for img in images[:10]], caption=theme)
+
+
+async def _send_gallery_by_upload(bot, chat_id: int, images: list, theme: str) -> None:
+    """Отправляет галерею загрузкой скачанных изображений."""
+    photos = []
+    for img in images:
+        if img["data"] is None:
+            continue
+        bio = io.BytesIO(img["data"])
+        bio.name = f"photo_{len(photos) + 1:02d}.jpg"
+        photos.append(bio)
+        if len(photos) == 10:
+            break
+
+    await send_album(bot, chat_id, photos, caption=theme)
+
+
 # ─────────────────────────────────────────────
 # Управление scheduled jobs
 # ─────────────────────────────────────────────
 
-def setup_scheduled_jobs(application, user_id: int, chat_id: int) -> None:
-    """Настраивает scheduled jobs для пользователя на основе его расписания."""
+def setup_scheduled_jobs(application, user_id: int, chat_id: int,
+                         schedule: Optional[dict] = None,
+                         offsets: Optional[Dict[int, int]] = None) -> None:
+    """
+    Настраивает scheduled jobs для пользователя на основе его расписания.
+
+    Args:
+        application: Экземпляр Application
+        user_id: ID пользователя Telegram
+        chat_id: ID чата доставки фотосессий
+        schedule: Расписание (по умолчанию читается из настроек пользователя)
+        offsets: Сдвиги старта по дням из plan_schedule_offsets (секунды)
+    """
     job_queue = application.job_queue
     job_name = f"photoshoot_{user_id}"
 
     # Удаляем существующие jobs
     remove_scheduled_jobs(application, user_id)
 
-    schedule = get_schedule(user_id)
+    if schedule is None:
+        schedule = get_schedule(user_id)
     if not schedule.get("enabled"):
         logger.info(f"Расписание для {user_id} выключено, jobs не создаются")
         return
@@ -168,21 +368,38 @@ def setup_scheduled_jobs(application, user_id: int, chat_id: int) -> None:
     days = schedule.get("days", [0, 3])
     num_photos = schedule.get("num_photos", 10)
 
-    job_time = time(hour=hour, minute=minute)
+    offsets = offsets or {}
+    duration = estimate_photoshoot_seconds(num_photos)
 
     for day in days:
+        # Сдвиг может перенести старт на следующий день
+        start = (day * 86400 + hour * 3600 + minute * 60 + offsets.get(day, 0)) % WEEK_SECONDS
+        start_day, seconds = divmod(start, 86400)
+        job_time = time(hour=seconds // 3600, minute=seconds // 60 % 60, second=seconds % 60)
+        arrival = (seconds + duration) % 86400
+        eta = f"{arrival // 3600:02d}:{arrival // 60 % 60:02d}"
+
+        # В расписании 0 — понедельник, а в JobQueue.run_daily 0 — воскресенье
         job_queue.run_daily(
             scheduled_photoshoot_job,
             time=job_time,
-            days=(day,),
-            data={"chat_id": chat_id, "user_id": user_id, "num_photos": num_photos},
+            days=((start_day + 1) % 7,),
+            data={"chat_id": chat_id, "user_id": user_id, "num_photos": num_photos, "eta": eta},
             name=f"{job_name}_day{day}",
         )
-        logger.info(f"Job создан: {job_name}_day{day} в {hour:02d}:{minute:02d}")
+        logger.info(f"Job создан: {job_name}_day{day} в {job_time:%H:%M:%S} (по расписанию {hour:02d}:{minute:02d})")
+
 
+def remove_scheduled_jobs(application, user_id: int, include_catchup: bool = False) -> None:
+    """
+    Удаляет scheduled jobs пользователя.
 
-def remove_scheduled_jobs(application, user_id: int) -> None:
-    """Удаляет все scheduled jobs для пользователя."""
+    Args:
+        application: Экземпляр Application
+        user_id: ID пользователя Telegram
+        include_catchup: Удалить и ожидающий догоняющий запуск — только при
+            выключении расписания; пересборка плана его не трогает
+    """
     job_name_prefix = f"photoshoot_{user_id}"
 
     # get_jobs_by_name ищет по точному имени, поэтому ищем по всем дням
@@ -191,3 +408,111 @@ def remove_scheduled_jobs(application, user_id: int) -> None:
         for job in jobs:
             job.schedule_removal()
             logger.info(f"Job удалён: {job.name}")
+
+    if include_catchup:
+        for job in application.job_queue.get_jobs_by_name(f"{job_name_prefix}_catchup"):
+            job.schedule_removal()
+            logger.info(f"Job удалён: {job.name}")
+
+
+def reschedule_photoshoots(application, schedules: Optional[Dict[int, dict]] = None) -> Dict[int, Dict[int, int]]:
+    """
+    Пересобирает scheduled jobs всех пользователей по общему плану запусков.
+
+    Вызывается при запуске бота и при каждом изменении расписания: сдвиги
+    зависят от расписаний всех пользователей.
+
+    Args:
+        application: Экземпляр Application
+        schedules: Включённые расписания (по умолчанию — get_enabled_schedules())
+
+    Returns:
+        Сдвиги старта: user_id -> {день: секунды}
+    """
+    if schedules is None:
+        schedules = get_enabled_schedules()
+    offsets = plan_schedule_offsets(schedules)
+
+    for user_id, schedule in schedules.items():
+        setup_scheduled_jobs(
+            application, user_id, schedule.get("chat_id", user_id), schedule, offsets.get(user_id)
+        )
+
+    delayed = sum(1 for days in offsets.values() for offset in days.values() if offset)
+    if delayed:
+        logger.info(f"План фотосессий: {delayed} запусков сдвинуто из-за лимита слотов fal.ai")
+    return offsets
+
+
+def restore_scheduled_jobs(application) -> int:
+    """
+    Восстанавливает scheduled jobs всех пользователей при запуске бота.
+
+    Включённые расписания читаются одним запросом (get_enabled_schedules),
+    без чтения настроек каждого пользователя. Если за время остановки бота
+    пропущен запуск, и с него прошло не больше SCHEDULE_CATCHUP_GRACE,
+    фотосессия запускается сразу.
+
+    Returns:
+        Количество восстановленных расписаний
+    """
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.warning(
+            "JobQueue недоступна (установите python-telegram-bot[job-queue]), "
+            "фотосессии по расписанию отключены"
+        )
+        return 0
+
+    schedules = get_enabled_schedules()
+    offsets = reschedule_photoshoots(application, schedules)
+    now = datetime.now(job_queue.scheduler.timezone)
+
+    missed_runs = {}
+    for user_id, schedule in schedules.items():
+        # Старт, сдвинутый планом раньше, может быть пропущен ещё до
+        # запланированного времени, поэтому проверяется и ближайшее
+        # время в пределах SCHEDULE_SPREAD
+        candidates = (
+            last_scheduled_time(schedule, now + timedelta(seconds=SCHEDULE_SPREAD)),
+            last_scheduled_time(schedule, now),
+        )
+        for missed in candidates:
+            if missed is None:
+                continue
+            # Сдвинутый планом старт ещё впереди — его выполнит обычная задача
+            if missed + timedelta(seconds=offsets.get(user_id, {}).get(missed.weekday(), 0)) > now:
+                continue
+            # Пропуском считается запуск позже последнего выполненного, а если
+            # расписание ещё не срабатывало — позже его включения. Расписания,
+            # включённые до появления этих полей, ограничены только окном ниже
+            since = schedule.get("last_run") or schedule.get("enabled_at") or 0
+            if missed.timestamp() > since and (now - missed).total_seconds() <= SCHEDULE_CATCHUP_GRACE:
+                missed_runs[user_id] = missed
+            break
+
+    # Догоняющие запуски распределяются тем же планом, как если бы все были
+    # назначены на одно время, но раньше старта бота начаться не могут
+    catchup_offsets = plan_schedule_offsets({
+        user_id: {**schedules[user_id], "days": [0], "hour": 0, "minute": 0}
+        for user_id in missed_runs
+    }, early=False)
+    for user_id, missed in missed_runs.items():
+        schedule = schedules[user_id]
+        # JobQueue запускается после post_init, поэтому разрешаем
+        # запоздалый старт (misfire_grace_time=None)
+        job_queue.run_once(
+            scheduled_photoshoot_job,
+            when=10 + catchup_offsets[user_id][0],
+            data={
+                "chat_id": schedule.get("chat_id", user_id),
+                "user_id": user_id,
+                "num_photos": schedule.get("num_photos", 10),
+            },
+            name=f"photoshoot_{user_id}_catchup",
+            job_kwargs={"misfire_grace_time": None},
+        )
+        logger.info(f"Пропущенная фотосессия {missed:%d.%m %H:%M} для {user_id} будет запущена после старта")
+
+    logger.info(f"Восстановлено расписаний фотосессий: {len(schedules)}")
+    return len(schedules)
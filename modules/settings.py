@@ -1,21 +1,48 @@
 """
 Модуль для работы с пользовательскими настройками.
+
+Настройки загружаются из хранилища (backend) один раз за время жизни
+процесса и хранятся в памяти (SettingsStore). Чтение не обращается
+к диску, а изменения помечают пользователя как «грязного» и сбрасываются
+в хранилище в фоне с задержкой (debounce).
+
+Доступные хранилища:
+- SQLiteSettingsBackend — строка на пользователя, WAL, запись только изменённых строк;
+- PickleSettingsBackend — весь словарь в одном файле с атомарной заменой.
 """
 
+import copy
+import json
 import os
 import pickle
-from typing import Dict, Any
+import threading
+import time
+from typing import Dict, Any, Optional, Set
 
 from modules.config import (
     DEFAULT_NUM_OUTPUTS, DEFAULT_ASPECT_RATIO, DEFAULT_PROMPT_STRENGTH,
     USER_SETTINGS_FILE, logger, DEFAULT_GEMINI_MODEL, DEFAULT_GENERATION_CYCLES,
-    DEFAULT_AUTO_CONFIRM_PROMPT
+    DEFAULT_AUTO_CONFIRM_PROMPT, SETTINGS_FLUSH_DELAY, SETTINGS_BACKEND, BOT_DB_FILE
 )
+from modules.storage import SQLiteDatabase
+
+
+def default_user_settings() -> Dict[str, Any]:
+    """Возвращает новый словарь настроек по умолчанию."""
+    return {
+        "num_outputs": DEFAULT_NUM_OUTPUTS,
+        "aspect_ratio": DEFAULT_ASPECT_RATIO,
+        "prompt_strength": DEFAULT_PROMPT_STRENGTH,
+        "gemini_model": DEFAULT_GEMINI_MODEL,
+        "generation_cycles": DEFAULT_GENERATION_CYCLES,
+        "auto_confirm_prompt": DEFAULT_AUTO_CONFIRM_PROMPT
+    }
+
 
 def load_user_settings() -> Dict[int, Dict[str, Any]]:
     """
-    Загружает настройки пользователей из файла.
-    
+    Загружает настройки пользователей из pickle-файла.
+
     Returns:
         Dict[int, Dict[str, Any]]: Словарь с настройками пользователей
     """
@@ -26,98 +53,323 @@ def load_user_settings() -> Dict[int, Dict[str, Any]]:
             return settings
         except Exception as e:
             logger.error(f"Ошибка при загрузке настроек: {e}")
-    
+
     return {}
 
 def save_user_settings(settings: Dict[int, Dict[str, Any]]) -> None:
     """
-    Сохраняет настройки пользователей в файл.
-    
+    Атомарно сохраняет настройки пользователей в pickle-файл.
+
+    Данные пишутся во временный файл рядом с основным и затем
+    подменяют его через os.replace, поэтому при падении процесса
+    на диске остаётся либо старая, либо новая версия целиком.
+
     Args:
         settings (Dict[int, Dict[str, Any]]): Словарь с настройками пользователей
     """
+    tmp_path = f"{USER_SETTINGS_FILE}.tmp"
     try:
-        with open(USER_SETTINGS_FILE, 'wb') as f:
+        with open(tmp_path, 'wb') as f:
             pickle.dump(settings, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, USER_SETTINGS_FILE)
     except Exception as e:
         logger.error(f"Ошибка при сохранении настроек: {e}")
 
+
+# ─────────────────────────────────────────────
+# Хранилища настроек
+# ─────────────────────────────────────────────
+
+class PickleSettingsBackend:
+    """Хранилище настроек в одном pickle-файле (перезаписывается целиком)."""
+
+    def __init__(self):
+        self._data: Dict[int, Dict[str, Any]] = {}
+
+    def load_all(self) -> Dict[int, Dict[str, Any]]:
+        """Загружает настройки всех пользователей."""
+        self._data = load_user_settings()
+        return copy.deepcopy(self._data)
+
+    def save_many(self, changes: Dict[int, Dict[str, Any]]) -> None:
+        """Сохраняет изменённых пользователей (файл переписывается полностью)."""
+        self._data.update(changes)
+        save_user_settings(self._data)
+
+    def load_enabled_schedules(self) -> Optional[Dict[int, Dict[str, Any]]]:
+        """Выборка расписаний не поддерживается — используется кэш в памяти."""
+        return None
+
+
+_SETTINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id INTEGER PRIMARY KEY,
+    settings TEXT NOT NULL,
+    photoshoot_schedule TEXT,
+    schedule_enabled INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_settings_schedule
+    ON user_settings(schedule_enabled);
+"""
+
+_UPSERT_SQL = """
+INSERT INTO user_settings (user_id, settings, photoshoot_schedule, schedule_enabled, updated_at)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    settings = excluded.settings,
+    photoshoot_schedule = excluded.photoshoot_schedule,
+    schedule_enabled = excluded.schedule_enabled,
+    updated_at = excluded.updated_at
+"""
+
+
+class SQLiteSettingsBackend:
+    """
+    Хранилище настроек в SQLite: одна строка на пользователя.
+
+    Расписание фотосессий хранится в отдельной колонке с индексом
+    по флагу включения, чтобы его можно было выбрать без загрузки
+    настроек всех пользователей.
+    """
+
+    def __init__(self, path: str = BOT_DB_FILE):
+        self._db = SQLiteDatabase(path, _SETTINGS_SCHEMA)
+
+    def load_all(self) -> Dict[int, Dict[str, Any]]:
+        """Загружает настройки всех пользователей, при необходимости мигрируя pickle."""
+        self._migrate_from_pickle()
+        with self._db.lock:
+            rows = self._db.conn.execute(
+                "SELECT user_id, settings, photoshoot_schedule FROM user_settings"
+            ).fetchall()
+        return {row["user_id"]: self._row_to_settings(row) for row in rows}
+
+    def save_many(self, changes: Dict[int, Dict[str, Any]]) -> None:
+        """Записывает изменённых пользователей одной транзакцией."""
+        now = time.time()
+        params = []
+        for user_id, user_settings in changes.items():
+            data = dict(user_settings)
+            schedule = data.pop("photoshoot_schedule", None)
+            params.append((
+                user_id,
+                json.dumps(data, ensure_ascii=False),
+                json.dumps(schedule, ensure_ascii=False) if schedule is not None else None,
+                1 if schedule and schedule.get("enabled") else 0,
+                now,
+            ))
+        with self._db.lock:
+            with self._db.conn:
+                self._db.conn.executemany(_UPSERT_SQL, params)
+
+    def load_enabled_schedules(self) -> Dict[int, Dict[str, Any]]:
+        """Возвращает включённые расписания фотосессий по индексу."""
+        with self._db.lock:
+            rows = self._db.conn.execute(
+                "SELECT user_id, photoshoot_schedule FROM user_settings WHERE schedule_enabled = 1"
+            ).fetchall()
+        return {row["user_id"]: json.loads(row["photoshoot_schedule"]) for row in rows}
+
+    @staticmethod
+    def _row_to_settings(row) -> Dict[str, Any]:
+        """Собирает словарь настроек из строки таблицы."""
+        settings = json.loads(row["settings"])
+        if row["photoshoot_schedule"] is not None:
+            settings["photoshoot_schedule"] = json.loads(row["photoshoot_schedule"])
+        return settings
+
+    def _migrate_from_pickle(self) -> None:
+        """Однократно переносит настройки из user_settings.pkl в SQLite."""
+        if not os.path.exists(USER_SETTINGS_FILE):
+            return
+
+        with self._db.lock:
+            count = self._db.conn.execute("SELECT COUNT(*) FROM user_settings").fetchone()[0]
+        if count:
+            logger.warning(
+                f"Найден {USER_SETTINGS_FILE}, но таблица настроек уже заполнена — миграция пропущена"
+            )
+            return
+
+        legacy = load_user_settings()
+        if legacy:
+            self.save_many(legacy)
+        os.replace(USER_SETTINGS_FILE, f"{USER_SETTINGS_FILE}.migrated")
+        logger.info(f"Мигрированы настройки {len(legacy)} пользователей из {USER_SETTINGS_FILE} в SQLite")
+
+
+def create_settings_backend(kind: str = SETTINGS_BACKEND):
+    """Создаёт хранилище настроек по имени из конфигурации."""
+    if kind == "pickle":
+        return PickleSettingsBackend()
+    if kind != "sqlite":
+        logger.warning(f"Неизвестное хранилище настроек '{kind}', используется sqlite")
+    return SQLiteSettingsBackend()
+
+
+class SettingsStore:
+    """
+    Процессный in-memory кэш настроек с отложенной записью на диск.
+
+    Все операции потокобезопасны: запись в хранилище выполняется из
+    фонового потока таймера, а обработчики вызывают методы из event loop.
+    """
+
+    def __init__(self, backend=None, flush_delay: float = SETTINGS_FLUSH_DELAY):
+        self._backend = backend
+        self._flush_delay = flush_delay
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._settings: Optional[Dict[int, Dict[str, Any]]] = None
+        self._dirty: Set[int] = set()
+        self._timer: Optional[threading.Timer] = None
+
+    def _ensure_loaded(self) -> Dict[int, Dict[str, Any]]:
+        """Загружает настройки из хранилища при первом обращении."""
+        if self._settings is None:
+            if self._backend is None:
+                self._backend = create_settings_backend()
+            self._settings = self._backend.load_all()
+            logger.info(f"Настройки загружены в память: {len(self._settings)} пользователей")
+        return self._settings
+
+    def load(self) -> None:
+        """Явно загружает настройки (вызывается при старте бота)."""
+        with self._lock:
+            self._ensure_loaded()
+
+    def get(self, user_id: int) -> Dict[str, Any]:
+        """Возвращает копию настроек пользователя, дополняя отсутствующие ключи."""
+        with self._lock:
+            settings = self._ensure_loaded()
+            user_settings = settings.get(user_id)
+            if user_settings is None:
+                user_settings = default_user_settings()
+                settings[user_id] = user_settings
+                self._mark_dirty(user_id)
+            else:
+                # Проверяем наличие новых параметров в настройках
+                for key, value in default_user_settings().items():
+                    if key not in user_settings:
+                        user_settings[key] = value
+                        self._mark_dirty(user_id)
+            return copy.deepcopy(user_settings)
+
+    def update(self, user_id: int, key: str, value: Any) -> None:
+        """Обновляет одно значение настроек пользователя."""
+        with self._lock:
+            settings = self._ensure_loaded()
+            user_settings = settings.setdefault(user_id, default_user_settings())
+            user_settings[key] = copy.deepcopy(value)
+            self._mark_dirty(user_id)
+
+    def reset(self, user_id: int) -> None:
+        """Сбрасывает настройки пользователя до значений по умолчанию."""
+        with self._lock:
+            settings = self._ensure_loaded()
+            settings[user_id] = default_user_settings()
+            self._mark_dirty(user_id)
+
+    def _mark_dirty(self, user_id: int) -> None:
+        """Помечает пользователя изменённым и планирует отложенную запись."""
+        self._dirty.add(user_id)
+        if self._timer is None:
+            self._timer = threading.Timer(self._flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def enabled_schedules(self) -> Dict[int, Dict[str, Any]]:
+        """Возвращает включённые расписания фотосессий всех пользователей."""
+        self.flush()
+        with self._lock:
+            self._ensure_loaded()
+            schedules = self._backend.load_enabled_schedules()
+            if schedules is not None:
+                return schedules
+            return {
+                user_id: copy.deepcopy(user_settings["photoshoot_schedule"])
+                for user_id, user_settings in self._settings.items()
+                if user_settings.get("photoshoot_schedule", {}).get("enabled")
+            }
+
+    def flush(self) -> None:
+        """Сбрасывает изменённых пользователей в хранилище, если они есть."""
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty or self._settings is None:
+                    return
+                changes = {
+                    user_id: copy.deepcopy(self._settings[user_id])
+                    for user_id in self._dirty
+                    if user_id in self._settings
+                }
+                self._dirty.clear()
+
+            # Запись выполняется вне основной блокировки,
+            # чтобы не задерживать чтение настроек из обработчиков
+            try:
+                self._backend.save_many(changes)
+                logger.info(f"Настройки сохранены (изменено пользователей: {len(changes)})")
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении настроек: {e}")
+                with self._lock:
+                    for user_id in changes:
+                        self._mark_dirty(user_id)
+
+
+# Единый экземпляр хранилища на процесс
+settings_store = SettingsStore()
+
+
 def get_user_settings(user_id: int) -> Dict[str, Any]:
     """
     Получает настройки пользователя.
-    
+
     Args:
         user_id (int): ID пользователя Telegram
-        
+
     Returns:
         Dict[str, Any]: Словарь с настройками пользователя
     """
-    settings = load_user_settings()
-    if user_id not in settings:
-        settings[user_id] = {
-            "num_outputs": DEFAULT_NUM_OUTPUTS,
-            "aspect_ratio": DEFAULT_ASPECT_RATIO,
-            "prompt_strength": DEFAULT_PROMPT_STRENGTH,
-            "gemini_model": DEFAULT_GEMINI_MODEL,
-            "generation_cycles": DEFAULT_GENERATION_CYCLES,
-            "auto_confirm_prompt": DEFAULT_AUTO_CONFIRM_PROMPT
-        }
-        save_user_settings(settings)
-    
-    # Проверяем наличие новых параметров в настройках
-    if "gemini_model" not in settings[user_id]:
-        settings[user_id]["gemini_model"] = DEFAULT_GEMINI_MODEL
-        save_user_settings(settings)
-        
-    if "generation_cycles" not in settings[user_id]:
-        settings[user_id]["generation_cycles"] = DEFAULT_GENERATION_CYCLES
-        save_user_settings(settings)
-    
-    if "auto_confirm_prompt" not in settings[user_id]:
-        settings[user_id]["auto_confirm_prompt"] = DEFAULT_AUTO_CONFIRM_PROMPT
-        save_user_settings(settings)
-    
-    return settings[user_id]
+    return settings_store.get(user_id)
 
 def update_user_settings(user_id: int, key: str, value: Any) -> None:
     """
     Обновляет настройки пользователя.
-    
+
     Args:
         user_id (int): ID пользователя Telegram
         key (str): Ключ настройки
         value (Any): Значение настройки
     """
-    settings = load_user_settings()
-    if user_id not in settings:
-        settings[user_id] = {
-            "num_outputs": DEFAULT_NUM_OUTPUTS,
-            "aspect_ratio": DEFAULT_ASPECT_RATIO,
-            "prompt_strength": DEFAULT_PROMPT_STRENGTH,
-            "gemini_model": DEFAULT_GEMINI_MODEL,
-            "generation_cycles": DEFAULT_GENERATION_CYCLES,
-            "auto_confirm_prompt": DEFAULT_AUTO_CONFIRM_PROMPT
-        }
-    
-    settings[user_id][key] = value
-    save_user_settings(settings)
+    settings_store.update(user_id, key, value)
     logger.info(f"Обновлены настройки пользователя {user_id}: {key}={value}")
 
 def reset_user_settings(user_id: int) -> None:
     """
     Сбрасывает настройки пользователя до значений по умолчанию.
-    
+
     Args:
         user_id (int): ID пользователя Telegram
     """
-    settings = load_user_settings()
-    settings[user_id] = {
-        "num_outputs": DEFAULT_NUM_OUTPUTS,
-        "aspect_ratio": DEFAULT_ASPECT_RATIO,
-        "prompt_strength": DEFAULT_PROMPT_STRENGTH,
-        "gemini_model": DEFAULT_GEMINI_MODEL,
-        "generation_cycles": DEFAULT_GENERATION_CYCLES,
-        "auto_confirm_prompt": DEFAULT_AUTO_CONFIRM_PROMPT
-    }
-    save_user_settings(settings)
-    logger.info(f"Сброшены настройки пользователя {user_id}") 
\ No newline at end of file
+    settings_store.reset(user_id)
+    logger.info(f"Сброшены настройки пользователя {user_id}")
+
+def flush_user_settings() -> None:
+    """Принудительно сохраняет несохранённые изменения настроек."""
+    settings_store.flush()
+
+def get_enabled_schedules() -> Dict[int, Dict[str, Any]]:
+    """
+    Возвращает включённые расписания фотосессий.
+
+    Returns:
+        Dict[int, Dict[str, Any]]: Словарь user_id -> photoshoot_schedule
+    """
+    return settings_store.enabled_schedules()
@@ -0,0 +1,49 @@
+"""
+Модуль для работы с локальной базой SQLite.
+Общие настройки подключения для всех хранилищ бота.
+"""
+
+import sqlite3
+import threading
+
+from modules.config import BOT_DB_FILE, logger
+
+
+def connect_sqlite(path: str = BOT_DB_FILE) -> sqlite3.Connection:
+    """
+    Открывает подключение к SQLite в режиме WAL.
+
+    Подключение можно использовать из нескольких потоков, но вызывающая
+    сторона должна сама сериализовать доступ к нему (см. SQLiteDatabase).
+
+    Args:
+        path: Путь к файлу базы данных
+
+    Returns:
+        Подключение к базе данных
+    """
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class SQLiteDatabase:
+    """Подключение к SQLite с блокировкой для доступа из разных потоков."""
+
+    def __init__(self, path: str = BOT_DB_FILE, schema: str = ""):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = connect_sqlite(path)
+        if schema:
+            with self.lock:
+                self.conn.executescript(schema)
+                self.conn.commit()
+        logger.info(f"Подключена база данных SQLite: {path}")
+
+    def close(self) -> None:
+        """Закрывает подключение."""
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,68 @@
+"""
+Модуль обработки обновлений Telegram.
+
+Обновления разных чатов обрабатываются параллельно, а обновления одного
+чата — строго по очереди, как без concurrent_updates: иначе второе
+сообщение, пришедшее во время генерации промпта, заново входило бы в
+ConversationHandler и перезаписывало context.user_data первого запроса.
+"""
+
+import asyncio
+import weakref
+from typing import Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# callback_data кнопок, которые должны срабатывать, пока обрабатывается
+# предыдущее обновление того же чата
+BYPASS_CALLBACKS = {"stream_cancel"}
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с очередью на каждый чат.
+
+    Для каждого чата (или пользователя, если чата нет) держится asyncio.Lock;
+    словарь блокировок слабый, поэтому блокировки простаивающих чатов
+    удаляются сами. Обновление, ожидающее свою очередь, занимает один из
+    max_concurrent_updates слотов. Нажатия кнопок из BYPASS_CALLBACKS
+    (остановка генерации промпта) обрабатываются без очереди.
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        async with lock:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        """Возвращает ключ очереди обновления или None, если очередь не нужна."""
+        if not isinstance(update, Update):
+            return None
+        query = update.callback_query
+        if query is not None and query.data in BYPASS_CALLBACKS:
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None